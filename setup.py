@@ -19,6 +19,9 @@ setuptools.setup(
     ],
     keywords='weo',
     packages=setuptools.find_packages(),
+    package_data={
+        'weo.bench': ['wics.schema'],
+    },
     entry_points={
         'console_scripts': [
             'weo=weo.cli:main',
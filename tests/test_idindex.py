@@ -0,0 +1,138 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from weo.idindex import id_index, interval_index
+from weo.ldap import BASE
+
+
+class fake_ldap(object):
+    "A wics_ldap that only answers paged searches, from fixed entries."
+
+    def __init__(self, people, groups):
+        self.entries = {'People': people, 'Group': groups}
+        self.primary = []
+
+    def search_paged(self, base, filterstr, attrlist=None, primary=False):
+        self.primary.append(primary)
+        return iter(self.entries[base.split(',')[0].split('=')[1]])
+
+
+def person(uid, number):
+    return ('uid=%s,ou=People,%s' % (uid, BASE),
+            {'uid': [uid], 'uidNumber': [str(number)],
+             'gidNumber': [str(number)]})
+
+
+def group(cn, number):
+    return ('cn=%s,ou=Group,%s' % (cn, BASE),
+            {'cn': [cn], 'gidNumber': [str(number)]})
+
+
+class IntervalIndexTest(unittest.TestCase):
+    def test_runs(self):
+        index = interval_index([5, 1, 2, 3, 9, 10, 3])
+        self.assertEqual(index.intervals(), [(1, 3), (5, 5), (9, 10)])
+        self.assertEqual(len(index), 6)
+        self.assertEqual(index.max(), 10)
+        self.assertEqual(interval_index().max(), None)
+
+    def test_contains(self):
+        index = interval_index([1, 2, 3, 9])
+        for n in (1, 2, 3, 9):
+            self.assertTrue(n in index)
+        for n in (0, 4, 8, 10):
+            self.assertFalse(n in index)
+
+    def test_add(self):
+        index = interval_index([1, 5, 9])
+        index.add(5)
+        self.assertEqual(index.intervals(), [(1, 1), (5, 5), (9, 9)])
+        index.add(4)
+        index.add(10)
+        self.assertEqual(index.intervals(), [(1, 1), (4, 5), (9, 10)])
+        index.add(0)
+        index.add(7)
+        self.assertEqual(index.intervals(),
+                         [(0, 1), (4, 5), (7, 7), (9, 10)])
+        # Filling the last hole between two runs merges them
+        index.add(6)
+        index.add(8)
+        self.assertEqual(index.intervals(), [(0, 1), (4, 10)])
+        self.assertEqual(len(index), 9)
+
+    def test_next_used(self):
+        index = interval_index([3, 4, 5, 9])
+        self.assertEqual(index.next_used(0), (3, 5))
+        self.assertEqual(index.next_used(4), (3, 5))
+        self.assertEqual(index.next_used(6), (9, 9))
+        self.assertEqual(index.next_used(10), None)
+
+    def test_gaps(self):
+        index = interval_index([3, 4, 5, 9])
+        self.assertEqual(list(index.gaps(0, 12)),
+                         [(0, 2), (6, 8), (10, 12)])
+        self.assertEqual(list(index.gaps(3, 9)), [(6, 8)])
+        self.assertEqual(list(index.gaps(3, 5)), [])
+        self.assertEqual(list(index.gaps(7, 7)), [(7, 7)])
+        self.assertEqual(list(interval_index().gaps(1, 2)), [(1, 2)])
+
+
+class IdIndexTest(unittest.TestCase):
+    def setUp(self):
+        people = [person('amy', 20000), person('jose', 20001),
+                  person('bob', 20004), person('eve', 20004),
+                  ('uid=nextuid,ou=People,' + BASE,
+                   {'uidNumber': ['20003'], 'gidNumber': ['20002']})]
+        groups = [group('amy', 20000), group('jose', 20001),
+                  group('bob', 20004), group('syscom', 10001),
+                  group('web', 10002),
+                  ('cn=nextgid,ou=Group,' + BASE, {'gidNumber': ['10002']})]
+        self.l = fake_ldap(people, groups)
+        self.index = id_index(self.l)
+
+    def test_scan(self):
+        self.assertEqual(self.l.primary, [True, True])
+        self.assertEqual(self.index.uids.intervals(),
+                         [(20000, 20001), (20004, 20004)])
+        self.assertEqual(self.index.gids.intervals(),
+                         [(10001, 10002), (20000, 20001), (20004, 20004)])
+        self.assertEqual(self.index.max_user, 20004)
+        self.assertEqual(self.index.max_group, 10002)
+
+    def test_collisions(self):
+        self.assertEqual(self.index.collisions['uidNumber'], {
+            20004: ['uid=bob,ou=People,' + BASE,
+                    'uid=eve,ou=People,' + BASE]})
+        self.assertEqual(self.index.collisions['gidNumber'], {})
+
+    def test_counter_fixes(self):
+        nextuid = 'uid=nextuid,ou=People,' + BASE
+        nextgid = 'cn=nextgid,ou=Group,' + BASE
+        self.assertEqual(self.index.counter_fixes(), [
+            (nextuid, 'gidNumber', 20002, 20005),
+            (nextuid, 'uidNumber', 20003, 20005),
+            (nextgid, 'gidNumber', 10002, 10003)])
+
+    def test_report(self):
+        lines = self.index.report()
+        self.assertTrue('uidNumber: 3 in use between 20000 and 20004, '
+                        '2 unused in 1 gaps' in lines)
+        self.assertTrue('  unused uidNumber: 20002-20003 (2)' in lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# The backends, which should only be imported by commands that use them
+BACKENDS = ['ldap', 'kadmin', 'dateutil']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter, so nothing this test imports interferes
+SCRIPT = '''
+import json
+import sys
+
+import weo.cli
+
+if %r is not None:
+    sys.argv = ['weo'] + %r
+    try:
+        weo.cli.main()
+    except SystemExit:
+        pass
+sys.stdout.flush()
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+
+def loaded_modules(args=None):
+    '''
+    Returns the names of the modules loaded by importing weo.cli and, unless
+    'args' is None, running weo with 'args'.
+    '''
+    proc = subprocess.Popen([sys.executable, '-c', SCRIPT % (args, args)],
+                            cwd=ROOT, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (_, err) = proc.communicate()
+    if proc.returncode != 0:
+        raise AssertionError('weo %s failed:\n%s' %
+                             (' '.join(args or []), err))
+    return set(json.loads(err.splitlines()[-1]))
+
+
+class ImportTest(unittest.TestCase):
+    def assert_no_backends(self, modules):
+        for name in BACKENDS:
+            loaded = [m for m in modules
+                      if m == name or m.startswith(name + '.')]
+            self.assertEqual(loaded, [], '%s was imported' % name)
+
+    def test_import(self):
+        self.assert_no_backends(loaded_modules())
+
+    def test_help(self):
+        self.assert_no_backends(loaded_modules(['-h']))
+
+
+if __name__ == '__main__':
+    unittest.main()
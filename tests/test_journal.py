@@ -0,0 +1,227 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from weo.journal import wics_journal
+from weo.provision import provision_users
+
+USERS = [('amy', 'Amy Smith', 'hunter2'), ('jose', 'Jose Ortiz', None)]
+
+
+class ALREADY_EXISTS(Exception):
+    "Stands in for python-ldap's"
+
+
+class DuplicateError(Exception):
+    "Named like kadmin's, which is all weo.krb5.is_duplicate looks at"
+
+
+class fake_ldap(object):
+    "A wics_ldap that keeps its users in a dict."
+
+    def __init__(self, next_id=20000):
+        self.next_id = next_id
+        self.users = {}
+        self.allocations = 0
+        self.exists_ok = None
+
+    def allocate_user_ids(self, uids):
+        self.allocations += 1
+        ids = dict((uid, self.next_id + i) for (i, uid) in enumerate(uids))
+        self.next_id += len(uids)
+        return ids
+
+    def add_users(self, users, ids=None, exists_ok=(), programs=None):
+        self.exists_ok = set(exists_ok)
+        results = []
+        for (uid, username) in users:
+            if uid in self.users and uid not in exists_ok:
+                results.append((uid, ALREADY_EXISTS(uid)))
+                continue
+            self.users[uid] = (username, ids[uid])
+            results.append((uid, None))
+        return results
+
+    def delete_user(self, uid):
+        del self.users[uid]
+
+
+class fake_krb5(object):
+    "A wics_krb5_pool that keeps its principals in a dict."
+
+    def __init__(self, fail=()):
+        self.princs = {}
+        self.fail = set(fail)
+
+    def add_princs(self, users):
+        errors = {}
+        for (uid, password) in users:
+            if uid in self.fail:
+                errors[uid] = RuntimeError('kadmin went away')
+            elif uid in self.princs:
+                errors[uid] = DuplicateError(uid)
+            else:
+                self.princs[uid] = password
+                errors[uid] = None
+        return errors
+
+    def del_princ(self, uid):
+        del self.princs[uid]
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        journal = wics_journal(self.path)
+        journal.intend('*', 'allocate', count=2)
+        journal.complete('*', 'allocate', ids={'amy': 20000})
+        journal.intend('amy', 'add_user')
+        journal.close()
+
+        journal = wics_journal(self.path)
+        self.assertTrue(journal.is_done('*', 'allocate'))
+        self.assertEqual(journal.data('*', 'allocate'),
+                         {'ids': {'amy': 20000}})
+        self.assertTrue(journal.is_pending('amy', 'add_user'))
+        self.assertEqual(journal.state('jose', 'add_user'), None)
+        journal.close()
+
+    def test_unsynced_records_are_lost(self):
+        journal = wics_journal(self.path)
+        journal.complete('amy', 'add_user')
+        self.assertTrue(journal.is_done('amy', 'add_user'))
+        self.assertEqual(wics_journal(self.path).done(), [])
+        journal.close()
+
+    def test_torn_last_line(self):
+        journal = wics_journal(self.path)
+        journal.complete('amy', 'add_user')
+        journal.close()
+        with open(self.path, 'a') as f:
+            f.write('{"key": "jose", "step": "add_')
+
+        journal = wics_journal(self.path)
+        self.assertEqual(journal.done(), [('amy', 'add_user')])
+        journal.complete('jose', 'add_user')
+        journal.close()
+
+        # What was written after the torn line survives the next resume
+        journal = wics_journal(self.path)
+        self.assertEqual(sorted(journal.done()),
+                         [('amy', 'add_user'), ('jose', 'add_user')])
+        journal.close()
+
+    def test_in_memory(self):
+        journal = wics_journal()
+        journal.fail('amy', 'add_princ', error='oops')
+        journal.close()
+        self.assertEqual(journal.state('amy', 'add_princ'), 'failed')
+        self.assertEqual(journal.data('amy', 'add_princ'), {'error': 'oops'})
+
+
+class ProvisionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+        self.l = fake_ldap()
+        self.k = fake_krb5()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def provision(self, users=USERS):
+        journal = wics_journal(self.path)
+        try:
+            return provision_users(self.l, self.k, users, journal)
+        finally:
+            journal.close()
+
+    def test_batch(self):
+        self.assertEqual(self.provision(), [('amy', None), ('jose', None)])
+        self.assertEqual(self.l.users, {'amy': ('Amy Smith', 20000),
+                                        'jose': ('Jose Ortiz', 20001)})
+        self.assertEqual(self.k.princs, {'amy': 'hunter2', 'jose': None})
+
+        # Rerunning a finished batch does nothing
+        self.assertEqual(self.provision(), [('amy', None), ('jose', None)])
+        self.assertEqual(self.l.allocations, 1)
+        self.assertEqual(len(self.l.users), 2)
+
+    def test_resume_after_crash(self):
+        # Crashed after amy was added to both, but before that was journaled
+        journal = wics_journal(self.path)
+        journal.intend('*', 'allocate', count=2)
+        ids = {'amy': 30000, 'jose': 30001}
+        journal.complete('*', 'allocate', ids=ids)
+        for (uid, _, _) in USERS:
+            journal.intend(uid, 'add_user', id=ids[uid])
+            journal.intend(uid, 'add_princ')
+        journal.close()
+        self.l.users['amy'] = ('Amy Smith', 30000)
+        self.k.princs['amy'] = 'hunter2'
+
+        self.assertEqual(self.provision(), [('amy', None), ('jose', None)])
+        # The journaled block was reused rather than reserving another
+        self.assertEqual(self.l.allocations, 0)
+        self.assertEqual(self.l.users['jose'], ('Jose Ortiz', 30001))
+        self.assertEqual(self.l.exists_ok, set(['amy', 'jose']))
+        # Pending adds that had already happened aren't rolled back
+        self.assertEqual(sorted(self.l.users), ['amy', 'jose'])
+        self.assertEqual(sorted(self.k.princs), ['amy', 'jose'])
+
+        journal = wics_journal(self.path)
+        self.assertEqual(len(journal.done()), 5)
+        journal.close()
+
+    def test_clash_without_journal_entry(self):
+        # An existing principal that we never tried to add is a clash
+        self.k.princs['amy'] = 'theirs'
+        results = dict(self.provision())
+        self.assertTrue(isinstance(results['amy'], DuplicateError))
+        self.assertEqual(results['jose'], None)
+        self.assertFalse('amy' in self.l.users)
+        self.assertEqual(self.k.princs['amy'], 'theirs')
+
+    def test_rollback_and_retry(self):
+        self.k.fail.add('jose')
+        results = dict(self.provision())
+        self.assertEqual(results['amy'], None)
+        self.assertTrue(isinstance(results['jose'], RuntimeError))
+        self.assertFalse('jose' in self.l.users)
+
+        self.k.fail.clear()
+        self.assertEqual(self.provision(), [('amy', None), ('jose', None)])
+        self.assertEqual(self.l.allocations, 1)
+        self.assertEqual(self.l.users['jose'], ('Jose Ortiz', 20001))
+        self.assertEqual(self.l.exists_ok, set())
+
+    def test_different_batch(self):
+        self.provision()
+        self.assertRaises(ValueError, self.provision,
+                          [('bob', 'Bob Jones', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from weo.snapshot import wics_snapshot, write_snapshot
+
+BASE = 'dc=wics,dc=uwaterloo,dc=ca'
+
+
+def person(uid, number, cn):
+    return ('uid=%s,ou=People,%s' % (uid, BASE), {
+        'uid': [uid], 'cn': [cn], 'uidNumber': [str(number)],
+        'gidNumber': [str(number)], 'homeDirectory': ['/home/' + uid],
+        'loginShell': ['/bin/bash']})
+
+
+def group(cn, number, members):
+    return ('cn=%s,ou=Group,%s' % (cn, BASE), {
+        'cn': [cn], 'gidNumber': [str(number)],
+        'uniqueMember': ['uid=%s,ou=People,%s' % (uid, BASE)
+                         for uid in members]})
+
+
+class fake_ldap(object):
+    "A wics_ldap that only answers paged searches, from fixed entries."
+
+    def __init__(self, people, groups):
+        self.entries = {'People': people, 'Group': groups}
+
+    def search_paged(self, base, filterstr, attrlist=None, primary=False):
+        return iter(self.entries[base.split(',')[0].split('=')[1]])
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+        people = [person('amy', 20001, 'Amy Smith'),
+                  person('jose', 20000, 'Jos\xc3\xa9 Ortiz'),
+                  ('uid=nextuid,ou=People,' + BASE,
+                   {'uid': ['nextuid'], 'uidNumber': ['20002'],
+                    'gidNumber': ['20002']})]
+        groups = [group('amy', 20001, ['amy']),
+                  group('jose', 20000, ['jose']),
+                  group('syscom', 10001, ['jose', 'amy'])]
+        self.written = write_snapshot(fake_ldap(people, groups), self.path)
+        self.snapshot = wics_snapshot(self.path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        shutil.rmtree(self.dir)
+
+    def test_counts(self):
+        self.assertEqual(self.written, (2, 3))
+        self.assertEqual(
+            [user['uid'] for user in self.snapshot.users()], ['jose', 'amy'])
+        self.assertEqual(
+            [g['cn'] for g in self.snapshot.groups()],
+            ['syscom', 'jose', 'amy'])
+
+    def test_get_user(self):
+        user = self.snapshot.get_user('jose')
+        self.assertEqual(user['cn'], 'Jos\xc3\xa9 Ortiz')
+        self.assertEqual(user['uidNumber'], 20000)
+        self.assertEqual(user['homeDirectory'], '/home/jose')
+        self.assertEqual(self.snapshot.get_user_by_uidnumber(20001)['uid'],
+                         'amy')
+
+    def test_get_group(self):
+        self.assertEqual(self.snapshot.get_group('syscom'),
+                         {'cn': 'syscom', 'gidNumber': 10001,
+                          'members': ['amy', 'jose']})
+        self.assertEqual(self.snapshot.get_group_by_gidnumber(20000)['cn'],
+                         'jose')
+
+    def test_missing(self):
+        self.assertEqual(self.snapshot.get_user('nextuid'), None)
+        self.assertEqual(self.snapshot.get_user('bob'), None)
+        self.assertEqual(self.snapshot.get_user_by_uidnumber(20002), None)
+        self.assertEqual(self.snapshot.get_group('bob'), None)
+        self.assertEqual(self.snapshot.get_group_by_gidnumber(1), None)
+
+    def test_replace(self):
+        write_snapshot(fake_ldap([person('bob', 20003, 'Bob')], []),
+                       self.path)
+        # Open readers keep the snapshot they opened
+        self.assertEqual(self.snapshot.get_user('amy')['uid'], 'amy')
+        newer = wics_snapshot(self.path)
+        try:
+            self.assertEqual(newer.get_user('amy'), None)
+            self.assertEqual(newer.get_user('bob')['uidNumber'], 20003)
+        finally:
+            newer.close()
+        self.assertEqual(os.listdir(self.dir), ['snapshot'])
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write('not a snapshot at all, just some text' * 4)
+        self.assertRaises(ValueError, wics_snapshot, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
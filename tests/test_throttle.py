@@ -0,0 +1,102 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import time
+import unittest
+
+from weo import throttle
+from weo.throttle import aimd_throttle
+
+
+class BUSY(Exception):
+    "Named like python-ldap's, which is all the throttle looks at"
+
+
+class fake_conn(object):
+    "An LDAPObject whose asynchronous writes all succeed at once."
+
+    def __init__(self):
+        self._msgids = itertools.count(1)
+        self.sent = []
+
+    def add_ext(self, dn, ml):
+        self.sent.append(dn)
+        return next(self._msgids)
+
+    modify_ext = add_ext
+
+    def result3(self, msgid):
+        return (None, [], msgid, [])
+
+
+class ThrottleTest(unittest.TestCase):
+    def test_grows_while_fast(self):
+        t = aimd_throttle(16)
+        for x in range(200):
+            t.release(t.acquire())
+        self.assertEqual(t.window(), 16)
+
+    def test_backs_off_once_per_round(self):
+        t = aimd_throttle(16)
+        t.limit = 8.0
+        starts = [t.acquire(wait=False) for x in range(8)]
+        for started in starts:
+            t.release(started, BUSY())
+        self.assertEqual(t.window(), 4)
+
+    def test_never_below_minimum(self):
+        t = aimd_throttle(16)
+        for x in range(10):
+            t.release(t.acquire(), BUSY())
+        self.assertEqual(t.window(), throttle.MIN_LIMIT)
+        self.assertTrue(t.has_room())
+
+    def test_rate(self):
+        t = aimd_throttle(16, rate=100)
+        start = time.time()
+        for x in range(10):
+            t.release(t.acquire())
+        self.assertTrue(time.time() - start >= 0.08)
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        from weo.pipeline import ldap_pipeline
+        self.ldap_pipeline = ldap_pipeline
+
+    def test_results_in_order(self):
+        pipe = self.ldap_pipeline(fake_conn(), max_inflight=2)
+        for n in range(5):
+            pipe.add('uid=u%d' % n, [])
+        self.assertEqual(pipe.results(),
+                         [('uid=u%d' % n, None) for n in range(5)])
+
+    def test_shared_throttle(self):
+        # A second pipeline on the same thread mustn't wait on requests the
+        # first one still has in flight
+        conn = fake_conn()
+        first = self.ldap_pipeline(conn, max_inflight=4)
+        for n in range(4):
+            first.modify('uid=u%d' % n, [])
+        second = self.ldap_pipeline(conn, throttle=first.throttle)
+        for n in range(4):
+            second.add('uid=v%d' % n, [])
+        self.assertEqual(len(second.results()), 4)
+        self.assertEqual(len(first.results()), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for weo, run against a throwaway slapd and a fake kadmin so they
+can be run anywhere OpenLDAP is installed. Run with
+
+    python -m weo.bench [-n OPS] [-c CLIENTS]
+'''
+
+from __future__ import absolute_import
+
+
+import getopt
+import sys
+import threading
+import time
+import weo.log
+
+from weo.bench import fake_kadmin
+
+# Defaults for the number of operations per benchmark and concurrent clients
+NUM_OPS = 200
+NUM_CLIENTS = 8
+
+
+def _summary(name, latencies, elapsed):
+    "Returns a report line for a benchmark's sorted latencies"
+    latencies = sorted(latencies)
+
+    def pct(q):
+        return 1000 * latencies[int(q * (len(latencies) - 1))]
+
+    return '%-28s %7d %9.1f %9.2f %9.2f %9.2f' % (
+        name, len(latencies), len(latencies) / elapsed, pct(0.5), pct(0.99),
+        1000 * latencies[-1])
+
+
+def measure(name, fn, args_list):
+    '''
+    Calls fn(*args) for each args in 'args_list' one after another, and
+    returns a report line with throughput and latency percentiles.
+    '''
+    weo.log.DAS_ERROR = False
+    latencies = []
+    start = time.time()
+    for args in args_list:
+        t = time.time()
+        fn(*args)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+
+    if weo.log.DAS_ERROR:
+        name += ' (ERRORS)'
+    return _summary(name, latencies, elapsed)
+
+
+def measure_concurrent(name, make_client, fn, clients, num_ops):
+    '''
+    Runs 'clients' threads, each with its own client from make_client(),
+    calling fn(client) 'num_ops' times in total between them, and returns a
+    report line as measure does.
+    '''
+    per_client = max(1, num_ops // clients)
+    conns = [make_client() for x in range(clients)]
+    latencies = []
+    go = threading.Event()
+
+    def worker(conn):
+        go.wait()
+        mine = []
+        for x in range(per_client):
+            t = time.time()
+            fn(conn)
+            mine.append(time.time() - t)
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(conn,))
+               for conn in conns]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    go.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    return _summary('%s x%d' % (name, clients), latencies, elapsed)
+
+
+def run(num_ops=NUM_OPS, clients=NUM_CLIENTS):
+    "Runs every benchmark, printing a line for each as it finishes"
+    fake_kadmin.install()
+
+    import weo.ldap
+    from weo.bench.slapd import bench_ldap, test_slapd
+    from weo.krb5 import wics_krb5
+
+    weo.log.DEBUG = False
+    print '%-28s %7s %9s %9s %9s %9s' % (
+        'benchmark', 'ops', 'ops/sec', 'p50 ms', 'p99 ms', 'max ms')
+
+    with test_slapd() as slapd:
+        ldap_cls = bench_ldap(slapd)
+        l = ldap_cls()
+        k = wics_krb5(password='benchmark')
+
+        users = ['u%05d' % i for i in range(num_ops)]
+        batch = ['b%05d' % i for i in range(num_ops)]
+        groups = ['g%05d' % i for i in range(num_ops)]
+
+        print measure('add_user', l.add_user,
+                      [(uid, 'Bench User') for uid in users])
+        print measure('add_users (batch of %d)' % num_ops, l.add_users,
+                      [([(uid, 'Bench User') for uid in batch],)])
+        print measure('add_group', l.add_group,
+                      [(gid, 'Bench Group') for gid in groups])
+        print measure('renew_user', l.renew_user,
+                      [(uid, 3) for uid in users])
+        print measure('add_user_to_group', l.add_user_to_group,
+                      [(groups[0], uid) for uid in users])
+        print measure('remove_user_from_group', l.remove_user_from_group,
+                      [(groups[0], uid) for uid in users])
+        print measure('sync_group', l.sync_group,
+                      [(groups[1], users[:i]) for i in (num_ops, 0)])
+        print measure('add_princ (fake kadmin)', k.add_princ,
+                      [(uid, 'password') for uid in users])
+
+        for allocator in ['lock', 'increment', 'cas']:
+            weo.ldap.ALLOCATOR = allocator
+            print measure_concurrent(
+                'allocate_ids (%s)' % allocator, ldap_cls,
+                lambda c: c.allocate_ids('cn=nextgid,ou=Group,' +
+                                         weo.ldap.BASE, ['gidNumber']),
+                clients, num_ops)
+        weo.ldap.ALLOCATOR = 'increment'
+
+
+def main():
+    (opts, _) = getopt.getopt(sys.argv[1:], 'n:c:')
+    opts = dict(opts)
+    run(int(opts.get('-n', NUM_OPS)), int(opts.get('-c', NUM_CLIENTS)))
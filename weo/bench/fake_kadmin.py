@@ -0,0 +1,91 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''
+An in-process stand-in for the python-kadmin module, with the subset of its
+API that weo uses. Principals live in a dict, and every call sleeps for
+LATENCY seconds to stand in for the round trip to the KDC.
+'''
+
+import sys
+import threading
+import time
+
+# Simulated round trip to kadmind, in seconds
+LATENCY = 0.005
+
+PRINCIPALS = {}
+_lock = threading.Lock()
+
+
+class KAdminError(Exception):
+    pass
+
+
+class DuplicateError(KAdminError):
+    pass
+
+
+class UnknownPrincipalError(KAdminError):
+    pass
+
+
+class principal(object):
+    'A fake kadmin principal'
+
+    def __init__(self, name, password):
+        self.name = name
+        self.password = password
+        self.expire = None
+
+    def commit(self):
+        time.sleep(LATENCY)
+
+
+class session(object):
+    'A fake kadmin admin session'
+
+    def addprinc(self, name, password=None):
+        time.sleep(LATENCY)
+        with _lock:
+            if name in PRINCIPALS:
+                raise DuplicateError(name)
+            PRINCIPALS[name] = principal(name, password)
+
+    def delprinc(self, name):
+        time.sleep(LATENCY)
+        with _lock:
+            if PRINCIPALS.pop(name, None) is None:
+                raise UnknownPrincipalError(name)
+
+    def getprinc(self, name):
+        time.sleep(LATENCY)
+        with _lock:
+            return PRINCIPALS.get(name)
+
+
+def init_with_password(admin, password):
+    time.sleep(LATENCY)
+    return session()
+
+
+def init_with_keytab(admin, keytab):
+    time.sleep(LATENCY)
+    return session()
+
+
+def install():
+    "Makes 'import kadmin' load this module instead of python-kadmin."
+    sys.modules['kadmin'] = sys.modules[__name__]
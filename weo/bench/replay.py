@@ -0,0 +1,162 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+'''
+Replays a trace recorded with --record against a throwaway slapd and the
+fake kadmin, optionally faster than it was recorded, to see how weo holds up
+under a heavier version of a real load.
+'''
+
+from __future__ import absolute_import
+
+
+import Queue
+import threading
+import time
+import types
+import weo.log
+
+from weo.bench import fake_kadmin
+from weo.trace import read_trace
+from weo.utils import to_utf8
+
+# Defaults for how much faster than recorded to replay, and for how many
+# clients to replay with
+SPEED = 1.0
+CONCURRENCY = 8
+
+
+def _pct(latencies, q):
+    return 1000 * latencies[int(q * (len(latencies) - 1))]
+
+
+class _client(object):
+    "One replay worker's connections, opened when the trace first needs them"
+
+    def __init__(self, ldap_cls):
+        from weo.krb5 import wics_krb5, wics_krb5_pool
+
+        self.factories = {
+            'ldap': ldap_cls,
+            'ldap.pipeline': lambda: self.conn('ldap').pipeline(),
+            'krb5': lambda: wics_krb5(password='replay'),
+            'krb5_pool': lambda: wics_krb5_pool(password='replay'),
+        }
+        self.conns = {}
+
+    def conn(self, obj):
+        if obj not in self.conns:
+            self.conns[obj] = self.factories[obj]()
+        return self.conns[obj]
+
+    def call(self, rec):
+        if rec['op'] == 'connect':
+            self.conns[rec['obj']] = self.factories[rec['obj']]()
+            return
+        if rec['obj'] == 'ldap' and rec['op'] == 'pipeline':
+            self.conns['ldap.pipeline'] = self.factories['ldap.pipeline']()
+            return
+
+        args = rec['args']
+        if rec['obj'] == 'ldap.pipeline' and rec['op'] in ('add', 'modify'):
+            # python-ldap only takes modlists made of tuples
+            args = [args[0], [tuple(mod) for mod in args[1]]] + args[2:]
+        result = getattr(self.conn(rec['obj']), rec['op'])(
+            *args, **rec['kwargs'])
+        if isinstance(result, types.GeneratorType):
+            for x in result:
+                pass
+
+
+def replay(path, speed=SPEED, concurrency=CONCURRENCY):
+    '''
+    Replays the trace at 'path', printing how each kind of call fared
+    compared to the recording.
+
+    speed: how many times faster than recorded to send calls
+    concurrency: how many clients to send them from; each has its own
+        connections, so contention between them is real
+    '''
+    fake_kadmin.install()
+    from weo.bench.slapd import bench_ldap, test_slapd
+
+    records = sorted(read_trace(path), key=lambda rec: rec['t'])
+    weo.log.DEBUG = False
+    print 'Replaying %d calls at %gx with %d clients...' % (
+        len(records), speed, concurrency)
+
+    work = Queue.Queue()
+    for rec in records:
+        work.put(rec)
+
+    results = {}
+    lock = threading.Lock()
+
+    with test_slapd() as slapd:
+        ldap_cls = bench_ldap(slapd)
+
+        def worker(start):
+            client = _client(ldap_cls)
+            while True:
+                try:
+                    rec = work.get_nowait()
+                except Queue.Empty:
+                    return
+
+                rec = to_utf8(rec)
+                due = start + rec['t'] / speed
+                if due > time.time():
+                    time.sleep(due - time.time())
+                late = time.time() - due
+
+                t = time.time()
+                err = None
+                try:
+                    client.call(rec)
+                except Exception as e:
+                    err = e
+                took = time.time() - t
+
+                key = '%s.%s' % (rec['obj'], rec['op'])
+                with lock:
+                    result = results.setdefault(key, {
+                        'recorded': [], 'replayed': [], 'late': [],
+                        'errors': 0, 'recorded_errors': 0})
+                    result['recorded'].append(rec['dur'])
+                    result['replayed'].append(took)
+                    result['late'].append(max(late, 0))
+                    result['errors'] += int(err is not None)
+                    result['recorded_errors'] += int(rec['err'] is not None)
+
+        start = time.time() + 0.1
+        threads = [threading.Thread(target=worker, args=(start,))
+                   for x in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+    print '%-28s %6s %10s %10s %10s %10s %7s' % (
+        'call', 'count', 'rec p50', 'p50 ms', 'p99 ms', 'late p99', 'errors')
+    for (key, result) in sorted(results.items()):
+        (recorded, replayed, late) = [sorted(result[k]) for k in
+                                      ('recorded', 'replayed', 'late')]
+        print '%-28s %6d %10.1f %10.1f %10.1f %10.1f %3d/%-3d' % (
+            key, len(replayed), _pct(recorded, 0.5), _pct(replayed, 0.5),
+            _pct(replayed, 0.99), _pct(late, 0.99), result['errors'],
+            result['recorded_errors'])
+    print 'Replayed in %.1fs; recorded over %.1fs.' % (
+        elapsed, records[-1]['t'] if records else 0)
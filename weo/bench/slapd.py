@@ -0,0 +1,191 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import ldap
+import ldap.modlist as modlist
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from weo.ldap import BASE, LDAP_ADMIN, wics_ldap
+
+# Where to look for OpenLDAP's slapd, its stock schema and its modules
+SLAPD_PATHS = ['/usr/sbin/slapd', '/usr/libexec/slapd',
+               '/usr/local/libexec/slapd', '/usr/local/sbin/slapd']
+SCHEMA_DIRS = ['/etc/ldap/schema', '/etc/openldap/schema',
+               '/usr/local/etc/openldap/schema']
+MODULE_DIRS = ['/usr/lib/ldap', '/usr/lib64/openldap', '/usr/lib/openldap']
+
+ROOT_PW = 'benchmark'
+START_TIMEOUT = 10
+
+SLAPD_CONF = '''
+include {schema_dir}/core.schema
+include {schema_dir}/cosine.schema
+include {schema_dir}/nis.schema
+include {wics_schema}
+
+pidfile {dir}/slapd.pid
+{modules}
+
+database mdb
+maxsize 1073741824
+suffix "{base}"
+rootdn "{rootdn}"
+rootpw {rootpw}
+directory {dir}/db
+
+index objectClass eq
+index uid,cn,term,uniqueMember eq
+index uidNumber,gidNumber eq
+'''
+
+# The entries weo expects to find in a fresh directory
+SEED = [
+    ('dc=wics,dc=uwaterloo,dc=ca', {
+        'objectClass': ['dcObject', 'organization'],
+        'dc': 'wics',
+        'o': 'Women in Computer Science'}),
+    ('ou=People,' + BASE, {
+        'objectClass': ['organizationalUnit'],
+        'ou': 'People'}),
+    ('ou=Group,' + BASE, {
+        'objectClass': ['organizationalUnit'],
+        'ou': 'Group'}),
+    ('uid=nextuid,ou=People,' + BASE, {
+        'objectClass': ['account', 'posixAccount', 'top'],
+        'uid': 'nextuid',
+        'cn': 'nextuid',
+        'uidNumber': '20000',
+        'gidNumber': '20000',
+        'homeDirectory': '/nonexistent'}),
+    ('cn=nextgid,ou=Group,' + BASE, {
+        'objectClass': ['posixGroup', 'top'],
+        'cn': 'nextgid',
+        'gidNumber': '30000'}),
+]
+
+
+def _find(paths, what):
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    raise OSError('Could not find %s in any of %s' % (what, paths))
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class test_slapd(object):
+    '''
+    A throwaway OpenLDAP server with the WiCS schema, running out of a
+    temporary directory and seeded with the People and Group OUs and the
+    nextuid/nextgid counters. Use it as a context manager.
+    '''
+
+    def __init__(self):
+        self.dir = None
+        self.proc = None
+        self.uri = None
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix='weo-slapd-')
+        os.mkdir(os.path.join(self.dir, 'db'))
+
+        modules = ''
+        for module_dir in MODULE_DIRS:
+            if os.path.exists(os.path.join(module_dir, 'back_mdb.la')):
+                modules = 'modulepath %s\nmoduleload back_mdb' % module_dir
+                break
+
+        conf = os.path.join(self.dir, 'slapd.conf')
+        with open(conf, 'w') as f:
+            f.write(SLAPD_CONF.format(
+                schema_dir=_find(SCHEMA_DIRS, 'the OpenLDAP schema'),
+                wics_schema=os.path.join(os.path.dirname(__file__),
+                                         'wics.schema'),
+                dir=self.dir, modules=modules, base=BASE,
+                rootdn=LDAP_ADMIN, rootpw=ROOT_PW))
+
+        self.uri = 'ldap://127.0.0.1:%d' % _free_port()
+        self.proc = subprocess.Popen(
+            [_find(SLAPD_PATHS, 'slapd'), '-f', conf, '-h', self.uri,
+             '-d', '0'],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+        conn = self.connect()
+        for (dn, attrs) in SEED:
+            conn.add_s(dn, modlist.addModlist(attrs))
+        conn.unbind_s()
+        return self
+
+    def connect(self):
+        "Returns a connection bound as the root DN, waiting for slapd to start"
+        deadline = time.time() + START_TIMEOUT
+        while True:
+            conn = ldap.initialize(self.uri)
+            try:
+                conn.simple_bind_s(LDAP_ADMIN, ROOT_PW)
+                return conn
+            except ldap.SERVER_DOWN:
+                if self.proc.poll() is not None or time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir)
+            self.dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def bench_ldap(slapd):
+    '''
+    Returns the wics_ldap class, adjusted to talk to 'slapd' with a simple
+    bind as the root DN rather than GSSAPI to auth1. UW directory lookups go
+    to our own members in 'slapd' too, so benchmarks and replays never load
+    the real one.
+    '''
+    import weo.ldap
+    weo.ldap.LDAP_SERVER = slapd.uri
+    weo.ldap.LDAP_REPLICAS = []
+    weo.ldap.UW_LDAP = slapd.uri
+    weo.ldap.UW_BASE = 'ou=People,' + BASE
+
+    class local_ldap(wics_ldap):
+        def bind(self, conn):
+            conn.simple_bind_s(LDAP_ADMIN, ROOT_PW)
+
+    return local_ldap
@@ -0,0 +1,321 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import os
+import sqlite3
+import time
+
+from weo import config
+from weo.log import debug, verbose
+from weo.utils import rdn_value
+
+# Where the local copy of the directory lives
+CACHE_PATH = os.environ.get(
+    'WEO_CACHE', os.path.expanduser('~/.cache/weo/directory.db'))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS people (
+    uid TEXT PRIMARY KEY, dn TEXT, cn TEXT,
+    uidNumber INTEGER, gidNumber INTEGER);
+CREATE INDEX IF NOT EXISTS people_uidnumber ON people (uidNumber);
+CREATE INDEX IF NOT EXISTS people_gidnumber ON people (gidNumber);
+
+CREATE TABLE IF NOT EXISTS terms (
+    uid TEXT, term TEXT, PRIMARY KEY (uid, term));
+
+CREATE TABLE IF NOT EXISTS groups (
+    cn TEXT PRIMARY KEY, dn TEXT, gidNumber INTEGER);
+CREATE INDEX IF NOT EXISTS groups_gidnumber ON groups (gidNumber);
+
+CREATE TABLE IF NOT EXISTS members (
+    cn TEXT, member TEXT, PRIMARY KEY (cn, member));
+CREATE INDEX IF NOT EXISTS members_member ON members (member);
+
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+
+CREATE TABLE IF NOT EXISTS uw (
+    uid TEXT PRIMARY KEY, found INTEGER, cn TEXT, program TEXT,
+    fetched REAL);
+'''
+
+# How long UW directory lookups are trusted for, in seconds. Programs and
+# names change rarely, and not finding someone is remembered as well, so a
+# rerun of the same import doesn't ask the university server again.
+UW_TTL = config.get_float('ldap', 'uw_cache_ttl')
+
+PEOPLE_ATTRS = ['uid', 'cn', 'uidNumber', 'gidNumber', 'term',
+                'modifyTimestamp']
+GROUP_ATTRS = ['cn', 'gidNumber', 'uniqueMember', 'modifyTimestamp']
+
+# The ID counters live alongside real entries, but aren't users or groups
+COUNTERS = set(['nextuid', 'nextgid', 'inuse'])
+
+
+def _int(entry, attr):
+    return int(entry[attr][0]) if attr in entry else None
+
+
+class wics_cache(object):
+    '''
+    A local, indexed copy of the People and Group entries in the WiCS LDAP
+    DB, kept up to date incrementally, so that lookups and batch validation
+    don't need a round trip to the server.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        path: (optional) the cache database; defaults to CACHE_PATH
+        '''
+        path = path or CACHE_PATH
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        # LDAP values are UTF-8 byte strings; store and return them as such
+        self.db.text_factory = str
+        self.db.executescript(SCHEMA)
+
+    def _meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row['value'] if row else None
+
+    def refresh(self, l, full=False):
+        '''
+        Brings the cache up to date with the directory. Entries modified since
+        the last refresh are fetched using modifyTimestamp; deleted entries
+        are found with a names-only search. With 'full', or on the first run,
+        everything is fetched again.
+
+        Both searches go to the primary: a replica may already hold newer
+        changes while older ones are still on their way, which would move
+        the modifyTimestamp mark past changes the cache never saw.
+
+        l: an open wics_ldap
+        full: (optional) whether to discard the cache and fetch everything
+        Returns the number of entries fetched.
+        '''
+        from weo.ldap import BASE
+
+        sections = [('People', PEOPLE_ATTRS, self._store_user),
+                    ('Group', GROUP_ATTRS, self._store_group)]
+        fetched = 0
+        with self.db:
+            for (ou, attrs, store) in sections:
+                since = None if full else self._meta('timestamp:' + ou)
+                if since is None:
+                    debug('Fetching all of ou=%s...' % ou)
+                    self._clear(ou)
+                    filterstr = '(objectClass=*)'
+                else:
+                    debug('Fetching ou=%s changes since %s...' % (ou, since))
+                    self._prune(ou, l.search_paged(
+                        'ou=%s,%s' % (ou, BASE), attrlist=['1.1'],
+                        primary=True))
+                    filterstr = '(modifyTimestamp>=%s)' % since
+
+                latest = since
+                for (dn, entry) in l.search_paged(
+                        'ou=%s,%s' % (ou, BASE), filterstr, attrs,
+                        primary=True):
+                    if rdn_value(dn) in COUNTERS:
+                        continue
+                    verbose('cache: ' + dn)
+                    store(dn, entry)
+                    fetched += 1
+                    stamp = entry.get('modifyTimestamp', [''])[0]
+                    if stamp > (latest or ''):
+                        latest = stamp
+
+                if latest is not None:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        ('timestamp:' + ou, latest))
+
+        debug('Fetched %d entries.' % fetched)
+        return fetched
+
+    def _clear(self, ou):
+        if ou == 'People':
+            self.db.execute('DELETE FROM people')
+            self.db.execute('DELETE FROM terms')
+        else:
+            self.db.execute('DELETE FROM groups')
+            self.db.execute('DELETE FROM members')
+
+    def _prune(self, ou, names):
+        "Drops cached entries of 'ou' that are not among the DNs 'names'"
+        if ou == 'People':
+            live = set(rdn_value(dn) for (dn, _) in names)
+            cached = [row['uid'] for row in
+                      self.db.execute('SELECT uid FROM people')]
+            for uid in set(cached) - live:
+                verbose('cache: dropping user ' + uid)
+                self.db.execute('DELETE FROM people WHERE uid = ?', (uid,))
+                self.db.execute('DELETE FROM terms WHERE uid = ?', (uid,))
+        else:
+            live = set(rdn_value(dn) for (dn, _) in names)
+            cached = [row['cn'] for row in
+                      self.db.execute('SELECT cn FROM groups')]
+            for cn in set(cached) - live:
+                verbose('cache: dropping group ' + cn)
+                self.db.execute('DELETE FROM groups WHERE cn = ?', (cn,))
+                self.db.execute('DELETE FROM members WHERE cn = ?', (cn,))
+
+    def _store_user(self, dn, entry):
+        uid = entry['uid'][0] if 'uid' in entry else rdn_value(dn)
+        self.db.execute(
+            'INSERT OR REPLACE INTO people VALUES (?, ?, ?, ?, ?)',
+            (uid, dn, entry.get('cn', [None])[0],
+             _int(entry, 'uidNumber'), _int(entry, 'gidNumber')))
+        self.db.execute('DELETE FROM terms WHERE uid = ?', (uid,))
+        self.db.executemany('INSERT INTO terms VALUES (?, ?)',
+                            [(uid, term) for term in
+                             set(entry.get('term', []))])
+
+    def _store_group(self, dn, entry):
+        cn = rdn_value(dn)
+        self.db.execute('INSERT OR REPLACE INTO groups VALUES (?, ?, ?)',
+                        (cn, dn, _int(entry, 'gidNumber')))
+        self.db.execute('DELETE FROM members WHERE cn = ?', (cn,))
+        self.db.executemany('INSERT INTO members VALUES (?, ?)',
+                            [(cn, rdn_value(member)) for member in
+                             set(entry.get('uniqueMember', []))])
+
+    def get_user(self, uid):
+        '''
+        Looks up a user by user id.
+
+        Returns a dict of the user's uid, dn, cn, uidNumber, gidNumber and
+        terms, or None if there is no such user.
+        '''
+        row = self.db.execute('SELECT * FROM people WHERE uid = ?',
+                              (uid,)).fetchone()
+        if row is None:
+            return None
+
+        user = dict(zip(row.keys(), row))
+        user['terms'] = sorted(r['term'] for r in self.db.execute(
+            'SELECT term FROM terms WHERE uid = ?', (uid,)))
+        return user
+
+    def get_user_by_uidnumber(self, uid_number):
+        "Looks up a user by UID number, returning it as get_user does."
+        row = self.db.execute('SELECT uid FROM people WHERE uidNumber = ?',
+                              (uid_number,)).fetchone()
+        return self.get_user(row['uid']) if row else None
+
+    def get_group(self, cn):
+        '''
+        Looks up a group by name.
+
+        Returns a dict of the group's cn, dn, gidNumber and members (as user
+        ids), or None if there is no such group.
+        '''
+        row = self.db.execute('SELECT * FROM groups WHERE cn = ?',
+                              (cn,)).fetchone()
+        if row is None:
+            return None
+
+        group = dict(zip(row.keys(), row))
+        group['members'] = sorted(r['member'] for r in self.db.execute(
+            'SELECT member FROM members WHERE cn = ?', (cn,)))
+        return group
+
+    def get_group_by_gidnumber(self, gid_number):
+        "Looks up a group by GID number, returning it as get_group does."
+        row = self.db.execute('SELECT cn FROM groups WHERE gidNumber = ?',
+                              (gid_number,)).fetchone()
+        return self.get_group(row['cn']) if row else None
+
+    def uw_lookup(self, l, uids, ttl=None):
+        '''
+        Looks up the users 'uids' in the UW directory, answering from the
+        cache where it can and fetching the rest in a few batched searches.
+
+        l: an open wics_ldap
+        uids: the user ids to look up
+        ttl: (optional) how old a cached answer may be, in seconds; defaults
+            to UW_TTL
+        Returns a dict mapping each user id that was found to a dict of its
+        'cn' and 'program', either of which may be None.
+        '''
+        ttl = UW_TTL if ttl is None else ttl
+        oldest = time.time() - ttl
+
+        found = {}
+        missing = []
+        for uid in set(uids):
+            row = self.db.execute(
+                'SELECT * FROM uw WHERE uid = ? AND fetched >= ?',
+                (uid, oldest)).fetchone()
+            if row is None:
+                missing.append(uid)
+            elif row['found']:
+                found[uid] = {'cn': row['cn'], 'program': row['program']}
+        debug('%d of %d users found in the UW cache.' %
+              (len(uids) - len(missing), len(uids)))
+
+        if missing:
+            fetched = l.uw_lookup(missing)
+            now = time.time()
+            with self.db:
+                for uid in missing:
+                    info = fetched.get(uid)
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO uw VALUES (?, ?, ?, ?, ?)',
+                        (uid, info is not None,
+                         info and info['cn'], info and info['program'],
+                         now))
+            found.update(fetched)
+
+        return found
+
+    def find_existing(self, l, uids=(), gids=()):
+        '''
+        Finds which of the user ids 'uids' and group names 'gids' are already
+        taken, as wics_ldap.find_existing does, answering from the cache
+        where it can. Names the cache doesn't have are looked up in LDAP, so
+        entries added since the last refresh are still found; entries
+        deleted since then are still reported until the next refresh.
+
+        l: an open wics_ldap
+        Returns a tuple (users, groups) of the sets of names that exist.
+        '''
+        users = self.existing_users(uids)
+        groups = self.existing_groups(gids)
+        misses = ([uid for uid in uids if uid not in users],
+                  [cn for cn in gids if cn not in groups])
+        debug('%d of %d names found in the cache.' %
+              (len(users) + len(groups), len(uids) + len(gids)))
+        if misses[0] or misses[1]:
+            (more_users, more_groups) = l.find_existing(*misses)
+            users |= more_users
+            groups |= more_groups
+        return (users, groups)
+
+    def existing_users(self, uids):
+        "Returns the set of those user ids in 'uids' that are in the cache."
+        return set(uid for uid in uids if self.db.execute(
+            'SELECT 1 FROM people WHERE uid = ?', (uid,)).fetchone())
+
+    def existing_groups(self, cns):
+        "Returns the set of those group names in 'cns' that are in the cache."
+        return set(cn for cn in cns if self.db.execute(
+            'SELECT 1 FROM groups WHERE cn = ?', (cn,)).fetchone())
@@ -16,14 +16,183 @@
 from __future__ import absolute_import
 
 
+import atexit
+import csv
 import getopt
+import json
+import os
 import sys
+import weo.krb5
 import weo.log
-
-from weo.krb5 import wics_krb5, REALM
-from weo.ldap import wics_ldap, BASE
-from weo.log import debug, exit_with_msg, verbose
-from weo.utils import check_username, get_user_password
+import weo.postprov
+import weo.stats
+import weo.trace
+
+from weo.daemon import call, serve, HANDLERS
+from weo.journal import wics_journal
+from weo.krb5 import wics_krb5, wics_krb5_pool, REALM
+from weo.log import debug, error, exit_with_msg, print_exc, verbose
+from weo.provision import provision_user, provision_users
+from weo.utils import (check_term, check_username, get_user_password,
+                       read_batch_file)
+
+
+def open_ldap():
+    '''
+    Imports the LDAP backend and connects to it. This is deferred until a
+    command actually needs LDAP, since loading python-ldap and binding are
+    the slowest parts of starting up.
+    '''
+    from weo.ldap import wics_ldap
+    return weo.trace.connect('ldap', wics_ldap)
+
+
+def validate_user_rows(rows, fullnames=True):
+    '''
+    Validates every row of a user batch up front, so that a typo on line 300
+    is caught before anything is written. Exits listing all of the bad rows
+    if any are found.
+
+    rows: a list of dicts with 'username' and 'fullname' keys
+    fullnames: (optional) whether to check for missing full names; off
+        before --uw-lookup has had a chance to fill them in
+    '''
+    problems = []
+    seen = set()
+    for (num, row) in enumerate(rows, 1):
+        try:
+            check_username(row['username'] or '')
+        except ValueError as e:
+            problems.append('row %d: %s' % (num, e))
+            continue
+        if fullnames and not row['fullname']:
+            problems.append('row %d: missing full name for %s' %
+                            (num, row['username']))
+        if row['username'] in seen:
+            problems.append('row %d: duplicate username %s' %
+                            (num, row['username']))
+        seen.add(row['username'])
+
+    if problems:
+        for problem in problems:
+            error(problem)
+        error('Batch is invalid, no users were added.')
+        sys.exit(1)
+
+
+# The member attributes shown by query commands, in output order
+MEMBER_FIELDS = ['uid', 'cn', 'uidNumber', 'term']
+
+
+def fill_from_uw(l, rows):
+    '''
+    Looks up the users of a batch in the UW directory, through the local
+    cache, filling in any missing full names and warning about any that
+    don't match.
+
+    l: an open wics_ldap
+    rows: a list of dicts with 'username' and 'fullname' keys
+    Returns a dict mapping user ids to their programs.
+    '''
+    from weo.cache import wics_cache
+
+    found = wics_cache().uw_lookup(
+        l, [row['username'] for row in rows if row['username']])
+
+    programs = {}
+    for row in rows:
+        info = found.get(row['username'])
+        if info is None:
+            if row['username']:
+                debug('%s: not in the UW directory' % row['username'])
+            continue
+        if not row['fullname']:
+            row['fullname'] = info['cn']
+        elif info['cn'] and row['fullname'].lower() != info['cn'].lower():
+            debug('%s: warning, the UW directory has them as %s, not %s' %
+                  (row['username'], info['cn'], row['fullname']))
+        if info['program']:
+            programs[row['username']] = info['program']
+    return programs
+
+
+def write_members(entries, fmt):
+    '''
+    Writes each member from the (dn, entry) iterable 'entries' to standard
+    output as soon as it arrives, as plain lines, CSV or JSON lines.
+
+    fmt: one of 'lines', 'csv' or 'json'
+    '''
+    if fmt not in ['lines', 'csv', 'json']:
+        raise ValueError('Unknown output format %s' % fmt)
+
+    writer = csv.writer(sys.stdout)
+    if fmt == 'csv':
+        writer.writerow(MEMBER_FIELDS)
+
+    count = 0
+    for (dn, entry) in entries:
+        if 'uid' not in entry:
+            entry['uid'] = [dn.split(',', 1)[0].split('=', 1)[1]]
+
+        if fmt == 'lines':
+            print entry['uid'][0]
+        elif fmt == 'csv':
+            writer.writerow([' '.join(sorted(entry.get(field, [])))
+                             for field in MEMBER_FIELDS])
+        else:
+            obj = dict((field, entry[field][0]) for field in MEMBER_FIELDS
+                       if field in entry)
+            obj['term'] = sorted(entry.get('term', []))
+            print json.dumps(obj, sort_keys=True)
+        count += 1
+
+    verbose('%d members listed' % count)
+
+
+def write_stats(fmt, path=None):
+    '''
+    Writes the operation stats recorded by this run in the format 'fmt',
+    to the file 'path' if given and otherwise to standard error.
+    '''
+    if path is None:
+        sys.stderr.write(weo.stats.report(fmt))
+        return
+
+    # Write then rename, so a scraper never sees a half-written file
+    with open(path + '.tmp', 'w') as f:
+        f.write(weo.stats.report(fmt))
+    os.rename(path + '.tmp', path)
+
+
+def send_to_daemon(opts, path):
+    '''
+    Forwards the command in 'opts' to a running weo daemon on the socket
+    'path' rather than opening our own connections, then exits. Returns
+    without doing anything if the daemon doesn't handle the command.
+    '''
+    commands = [c for c in sorted(HANDLERS) if '--' + c in opts]
+    if not commands:
+        return
+
+    command = commands[0]
+    req = {'command': command}
+    for param in ['username', 'fullname', 'groupname', 'groupdesc']:
+        if opts.get('--' + param):
+            req[param] = opts['--' + param]
+    if opts.get('--num-terms'):
+        req['num_terms'] = int(opts['--num-terms'])
+    if command in ['adduser', 'add-krb-princ']:
+        req['password'] = get_user_password(
+            "Please enter the new user's password: ")
+
+    debug('Sending %s to the weo daemon at %s' % (command, path))
+    resp = call(req, path)
+    for msg in resp['errors']:
+        error(msg)
+
+    exit_with_msg('Daemon failed to run %s :(' % command,
+                  'Daemon ran %s successfully.' % command)
 
 
 def main():
@@ -35,14 +204,60 @@ Usage: python weo.py [OPTIONS...]
 
   -h, --help    Prints this help message
   -v            Turns on verbose mode
+  --max-inflight=[n]        The most LDAP requests batch commands may
+                            have outstanding at once (default 32); they
+                            start lower and ramp up while LDAP keeps up
+  --stats                   Reports how many LDAP and Kerberos operations
+                            were made, how many failed and how long they
+                            took, on exit
+  --stats-format=[fmt]      Format for --stats: text (the default), json
+                            or prometheus
+  --stats-file=[path]       Writes --stats to this file rather than
+                            standard error
+  --record=[trace]          Records every LDAP and Kerberos call made,
+                            with its arguments and timing, to a gzipped
+                            trace file. Passwords are left out.
+  --replay=[trace]          Replays a recorded trace against a throwaway
+                            slapd and a fake kadmin (as the benchmarks
+                            do), with --speed=[n]x times faster than
+                            recorded and --concurrency=[n] clients
+                            (default 8), and compares the timings.
+  --socket=[path]           Sends standard commands to the weo daemon
+                            listening on this socket, rather than
+                            connecting directly. Also read from the
+                            WEO_SOCKET environment variable.
 
   Standard commands
   -----------------
   --renew                   Renews a user's account. Can optionally
                             specify number of terms, up to three (i.e.
                             --num-terms=2). Must specify --username
+  --sync-group=[name]       Makes a group's members exactly the users
+                            listed in --members-file, one username per
+                            line, or - for standard input.
+  --renew-batch=[file]      Renews every user listed in a file, one
+                            username per line, or - for standard input.
+                            Takes --num-terms like --renew.
   --adduser                 Adds a user. Must also specify
                             --username and --fullname
+  --adduser-batch=[file]    Adds every user listed in a CSV (username,
+                            fullname[,password]) or JSONL file. Users
+                            without a password are prompted for one.
+  --uw-lookup               With --adduser or --adduser-batch, looks
+                            users up in the UW directory to fill in
+                            their programs and any missing full names.
+                            Results are cached for a week in the local
+                            cache (see --refresh-cache).
+  --post-provision          After --adduser or --adduser-batch, creates
+                            each new user's home directory from the
+                            skeleton and runs the site's hooks on this
+                            host. Can be turned on in the [postprov]
+                            config section instead, and off again with
+                            --no-post-provision.
+  --journal=[file]          Records the progress of --adduser-batch or
+                            --renew-batch in this file. If the batch is
+                            interrupted, rerun it with the same journal
+                            to finish it off without redoing anything.
   --addgroup                Adds a group. Must also specify
                             --groupname and --groupdesc
   --add-user-to-group       Adds a user to a group. Must also specify
@@ -65,12 +280,73 @@ Usage: python weo.py [OPTIONS...]
   LDAP Only:
   --add-ldap-user           Adds a user to the LDAP database. Must also
                             specify --username and --fullname
+  --id-report               Scans every UID and GID in use, and reports
+                            where the nextuid/nextgid counters stand,
+                            numbers used more than once, and gaps.
+  --repair-counters         As --id-report, then moves any counter that
+                            is behind numbers in use, or whose UID and
+                            GID differ, past them. Only reports with
+                            --dry-run.
+  --expire-sweep            Disables every member who hasn't renewed
+                            since before --before (e.g. --before=w2025):
+                            sets their shell to /sbin/nologin and locks
+                            their Kerberos principal. With --delete,
+                            removes their entries, personal group, group
+                            memberships and principal instead. Prints
+                            what it will do first; with --dry-run, only
+                            prints it.
   --unlock-nextuid          Unlocks the special nextuid user.
   --unlock-nextgid          Unlocks the special nextgid group.
 
+  --reconcile=[file]        Makes the directory match a desired-state
+                            file (JSON, or YAML if PyYAML is installed)
+                            of users and groups, writing only what
+                            differs. With --dry-run, prints the plan
+                            without changing anything.
+
+  Queries:
+  --list-members            Lists members, or only those paid up for a
+                            term if --term is given (e.g. --term=f2026)
+  --expired                 Lists members who haven't renewed since
+                            before --since (e.g. --since=w2025)
+  --format=[fmt]            Output format for queries: lines (the
+                            default), csv or json (one object per line)
+
+  Local cache:
+  --refresh-cache           Fetches changes to users and groups into the
+                            local cache (WEO_CACHE, default
+                            ~/.cache/weo/directory.db). Add --full to
+                            fetch everything again. Once there is a
+                            cache, --adduser-batch checks it for clashes
+                            before asking LDAP.
+  --export-snapshot=[path]  Writes every user and group to a compact,
+                            indexed snapshot file for fast lookups on
+                            shell hosts (see weo/snapshot.py). The old
+                            snapshot is replaced atomically.
+  --show-user=[name]        Shows a user from the local cache, by user
+                            id or UID number.
+  --show-group=[name]       Shows a group from the local cache, by name
+                            or GID number.
+
+  Daemon:
+  --serve                   Runs the weo daemon, keeping LDAP and
+                            Kerberos connections open and answering
+                            requests on --socket (default
+                            /var/run/weo/weo.sock)
+
   Kerberos Only:
   --add-krb-princ           Adds a Kerberos principal for a user. Must
                             also specify --username
+  --add-krb-princ-batch=[file]
+                            Adds a Kerberos principal for every user in
+                            a CSV (username,password) or JSONL file, or
+                            - for standard input. With --random-key,
+                            only usernames are needed and principals
+                            get random keys.
+  --keytab=[path]           Authenticates as the Kerberos admin with
+                            this keytab rather than a password. Also
+                            read from the WEO_KEYTAB environment
+                            variable.
 '''
 
     # getopt returns options and arguments, but we take no arguments
@@ -83,34 +359,108 @@ Usage: python weo.py [OPTIONS...]
             'unlock-nextgid',
             'add-ldap-user',
             'add-krb-princ',
+            'add-krb-princ-batch=',
+            'random-key',
+            'keytab=',
             'adduser',
+            'adduser-batch=',
             'addgroup',
             'add-user-to-group',
             'remove-user-from-group',
             'renew',
+            'renew-batch=',
+            'journal=',
+            'uw-lookup',
+            'post-provision',
+            'record=',
+            'replay=',
+            'speed=',
+            'concurrency=',
+            'id-report',
+            'repair-counters',
+            'no-post-provision',
+            'sync-group=',
+            'members-file=',
             'username=',
             'fullname=',
             'groupname=',
             'groupdesc=',
             'num-terms=',
+            'max-inflight=',
+            'stats',
+            'stats-format=',
+            'stats-file=',
+            'reconcile=',
+            'dry-run',
+            'expire-sweep',
+            'before=',
+            'delete',
+            'list-members',
+            'expired',
+            'term=',
+            'since=',
+            'format=',
+            'refresh-cache',
+            'full',
+            'export-snapshot=',
+            'show-user=',
+            'show-group=',
+            'serve',
+            'socket=',
         ])
 
     opts = dict(opts)
     if '-v' in opts:
         weo.log.VERBOSE = True
 
+    if '--stats' in opts:
+        atexit.register(write_stats, opts.get('--stats-format', 'text'),
+                        opts.get('--stats-file'))
+
+    if '--keytab' in opts:
+        weo.krb5.KRB_KEYTAB = opts['--keytab']
+
+    if '--record' in opts:
+        weo.trace.start(opts['--record'])
+        atexit.register(weo.trace.stop)
+
+    if '--replay' in opts:
+        from weo.bench.replay import replay, CONCURRENCY
+
+        replay(opts['--replay'],
+               speed=float(opts.get('--speed', '1').rstrip('x')),
+               concurrency=int(opts.get('--concurrency', CONCURRENCY)))
+        sys.exit(0)
+
+    if '--post-provision' in opts:
+        weo.postprov.ENABLED = True
+    if '--no-post-provision' in opts:
+        weo.postprov.ENABLED = False
+
+    if '--max-inflight' in opts:
+        import weo.pipeline
+        weo.pipeline.MAX_INFLIGHT = int(opts['--max-inflight'])
+
     verbose('opts: ' + str(opts))
 
     if not opts or '--help' in opts or '-h' in opts:
         print_usage()
         sys.exit(0)
 
+    if '--serve' in opts:
+        serve(opts.get('--socket'))
+        sys.exit(0)
+
+    socket_path = opts.get('--socket') or os.environ.get('WEO_SOCKET')
+    if socket_path:
+        send_to_daemon(opts, socket_path)
+
     if '--add-ldap-user' in opts:
         if opts.get('--username') and opts.get('--fullname'):
             username = check_username(opts['--username'])
             debug('Okay, adding user %s' % username)
 
-            l = wics_ldap()
+            l = open_ldap()
             l.add_user(username, opts['--fullname'])
 
             exit_with_msg(
@@ -123,7 +473,7 @@ Usage: python weo.py [OPTIONS...]
             debug('Okay, adding Kerberos principal %s@%s' %
                   (username, REALM))
 
-            k = wics_krb5()
+            k = weo.trace.connect('krb5', wics_krb5)
             k.add_princ(username)
 
             exit_with_msg(
@@ -131,8 +481,46 @@ Usage: python weo.py [OPTIONS...]
                                                                REALM),
                 'Principal %s@%s successfully added.' % (username, REALM))
 
+    if '--add-krb-princ-batch' in opts:
+        rows = read_batch_file(opts['--add-krb-princ-batch'],
+                               ['username', 'password'])
+        random_key = '--random-key' in opts
+
+        problems = []
+        for (num, row) in enumerate(rows, 1):
+            try:
+                check_username(row['username'] or '')
+            except ValueError as e:
+                problems.append('row %d: %s' % (num, e))
+            if not row['password'] and not random_key:
+                problems.append('row %d: missing password for %s' %
+                                (num, row['username']))
+        if problems:
+            for problem in problems:
+                error(problem)
+            error('Batch is invalid, no principals were added.')
+            sys.exit(1)
+
+        debug('Okay, adding %d Kerberos principals' % len(rows))
+        k = weo.trace.connect('krb5_pool', wics_krb5_pool)
+        errors = k.add_princs([
+            (row['username'], None if random_key else row['password'])
+            for row in rows])
+
+        for row in rows:
+            if errors[row['username']] is None:
+                debug('%s@%s: added' % (row['username'], REALM))
+            else:
+                error('%s@%s: failed (%s)' %
+                      (row['username'], REALM, errors[row['username']]))
+
+        exit_with_msg(
+            'Failed to add some Kerberos principals :(',
+            'All %d principals successfully added.' % len(rows))
+
     if '--adduser' in opts:
-        if opts.get('--username') and opts.get('--fullname'):
+        if opts.get('--username') and (opts.get('--fullname') or
+                                       '--uw-lookup' in opts):
             username = check_username(opts['--username'])
             debug('Okay, adding user %s' % username)
 
@@ -141,21 +529,94 @@ Usage: python weo.py [OPTIONS...]
             password = get_user_password(
                 "Please enter the new user's password: ")
 
-            l = wics_ldap()
-            k = wics_krb5()
-            l.add_user(username, opts['--fullname'])
-            k.add_princ(username, password=password)
+            l = open_ldap()
+            row = {'username': username, 'fullname': opts.get('--fullname')}
+            programs = {}
+            if '--uw-lookup' in opts:
+                programs = fill_from_uw(l, [row])
+            if not row['fullname']:
+                error('No full name given, and none found for %s.' %
+                      username)
+                sys.exit(1)
+
+            k = weo.trace.connect('krb5', wics_krb5)
+            if (provision_user(l, k, username, row['fullname'], password,
+                               programs.get(username)) and
+                    weo.postprov.ENABLED):
+                weo.postprov.post_provision(l, [username])
 
             exit_with_msg(
                 'Failed to add user %s :(' % username,
                 'User %s successfully added.' % username)
 
+    if '--adduser-batch' in opts:
+        rows = read_batch_file(opts['--adduser-batch'],
+                               ['username', 'fullname', 'password'])
+        l = None
+        programs = {}
+        if '--uw-lookup' in opts:
+            # Only go to the network for a batch that's otherwise valid
+            validate_user_rows(rows, fullnames=False)
+            l = open_ldap()
+            programs = fill_from_uw(l, rows)
+        validate_user_rows(rows)
+
+        # Find clashes before allocating anything, rather than having each
+        # add fail and roll back
+        journal = wics_journal(opts.get('--journal'))
+        l = l or open_ldap()
+        from weo.cache import CACHE_PATH, wics_cache
+
+        usernames = [row['username'] for row in rows]
+        if os.path.exists(CACHE_PATH):
+            (users, groups) = wics_cache().find_existing(
+                l, usernames, usernames)
+        else:
+            (users, groups) = l.find_existing(usernames, usernames)
+        for row in rows:
+            # Entries the journal says we added ourselves aren't clashes
+            if (row['username'] in users | groups and
+                    journal.state(row['username'], 'add_user') is None):
+                error('%s: failed (already exists)' % row['username'])
+                usernames.remove(row['username'])
+        rows = [row for row in rows if row['username'] in usernames]
+        if not rows:
+            exit_with_msg('No users left to add :(', 'Nothing to do.')
+        debug('Okay, adding %d users' % len(rows))
+
+        # Collect any missing passwords before opening KRB connections
+        for row in rows:
+            if journal.is_done(row['username'], 'add_princ'):
+                continue
+            if not row['password']:
+                row['password'] = get_user_password(
+                    'Please enter the password for %s: ' % row['username'])
+
+        k = weo.trace.connect('krb5_pool', wics_krb5_pool)
+        results = provision_users(l, k, [
+            (row['username'], row['fullname'], row['password'])
+            for row in rows], journal=journal, programs=programs)
+        journal.close()
+
+        for (username, err) in results:
+            if err is None:
+                debug('%s: added' % username)
+            else:
+                error('%s: failed (%s)' % (username, err))
+        added = [username for (username, err) in results if err is None]
+        if added and weo.postprov.ENABLED:
+            weo.postprov.post_provision(l, added)
+
+        exit_with_msg(
+            'Failed to add some users :(',
+            'All %d users successfully added.' % len(rows))
+
     if '--addgroup' in opts:
         if opts.get('--groupname') and opts.get('--groupdesc'):
             groupname = check_username(opts['--groupname'], maxlen=10)
             debug('Okay, adding group %s' % groupname)
 
-            l = wics_ldap()
+            l = open_ldap()
             l.add_group(groupname, opts['--groupdesc'])
 
             exit_with_msg(
@@ -168,7 +629,7 @@ Usage: python weo.py [OPTIONS...]
             groupname = opts['--groupname']
             debug('Okay, adding user %s to group %s' % (username, groupname))
 
-            l = wics_ldap()
+            l = open_ldap()
             l.add_user_to_group(groupname, username)
 
             exit_with_msg(
@@ -183,7 +644,7 @@ Usage: python weo.py [OPTIONS...]
             debug('Okay, removing user %s from group %s' %
                   (username, groupname))
 
-            l = wics_ldap()
+            l = open_ldap()
             l.remove_user_from_group(groupname, username)
 
             exit_with_msg(
@@ -197,7 +658,7 @@ Usage: python weo.py [OPTIONS...]
             username = opts['--username']
             num_terms = opts.get('--num-terms')
 
-            l = wics_ldap()
+            l = open_ldap()
             if num_terms is not None:
                 debug('Okay, renewing user %s for %s terms' %
                       (username, num_terms))
@@ -210,13 +671,184 @@ Usage: python weo.py [OPTIONS...]
                 'Failed to renew user %s for specified terms :(' % username,
                 'User %s successfully renewed!' % username)
 
+    if '--sync-group' in opts:
+        if opts.get('--members-file'):
+            groupname = opts['--sync-group']
+            rows = read_batch_file(opts['--members-file'], ['username'])
+            usernames = [check_username(row['username']) for row in rows
+                         if row['username']]
+            debug('Okay, syncing group %s to %d members' %
+                  (groupname, len(usernames)))
+
+            l = open_ldap()
+            try:
+                (added, removed) = l.sync_group(groupname, usernames)
+                debug('Added %d members, removed %d.' %
+                      (len(added), len(removed)))
+            except:
+                print_exc(sys.exc_info())
+
+            exit_with_msg(
+                'Failed to sync group %s :(' % groupname,
+                'Group %s successfully synced.' % groupname)
+
+    if '--renew-batch' in opts:
+        rows = read_batch_file(opts['--renew-batch'], ['username'])
+        usernames = [row['username'] for row in rows if row['username']]
+        num_terms = opts.get('--num-terms')
+
+        # Users renewed by an earlier, interrupted run are already done
+        journal = wics_journal(opts.get('--journal'))
+        usernames = [username for username in usernames
+                     if not journal.is_done(username, 'renew')]
+        debug('Okay, renewing %d users' % len(usernames))
+
+        l = open_ldap()
+        (renewed, current, failed) = l.renew_users(
+            usernames, num_terms=int(num_terms) if num_terms else None)
+        for username in renewed + current:
+            journal.complete(username, 'renew')
+        journal.close()
+
+        for (username, err) in failed:
+            error('%s: failed (%s)' % (username, err))
+        debug('%d renewed, %d already current, %d failed.' %
+              (len(renewed), len(current), len(failed)))
+
+        exit_with_msg(
+            'Failed to renew some users :(',
+            'All users successfully renewed!')
+
+    if '--reconcile' in opts:
+        from weo.reconcile import apply, describe, load_state, plan
+
+        state = load_state(opts['--reconcile'])
+        debug('Okay, reconciling %d users and %d groups' %
+              (len(state['users']), len(state['groups'])))
+
+        l = open_ldap()
+        actions = plan(l, state)
+        for action in actions:
+            debug(describe(action))
+
+        if not actions:
+            debug('Nothing to do.')
+        elif '--dry-run' not in opts:
+            apply(l, actions)
+
+        exit_with_msg('Failed to reconcile some entries :(',
+                      'Reconciled with %d changes.' %
+                      (0 if '--dry-run' in opts else len(actions)))
+
+    if '--list-members' in opts:
+        term = opts.get('--term')
+        if term is not None:
+            check_term(term)
+
+        l = open_ldap()
+        write_members(l.list_members(term, MEMBER_FIELDS),
+                      opts.get('--format', 'lines'))
+        sys.exit(0)
+
+    if '--expired' in opts:
+        if opts.get('--since'):
+            since = check_term(opts['--since'])
+
+            l = open_ldap()
+            write_members(l.list_expired(since, MEMBER_FIELDS),
+                          opts.get('--format', 'lines'))
+            sys.exit(0)
+
+    if '--expire-sweep' in opts:
+        if opts.get('--before'):
+            from weo.sweep import apply, describe, plan
+
+            before = check_term(opts['--before'])
+            l = open_ldap()
+            actions = plan(l, before, delete='--delete' in opts)
+            for action in actions:
+                debug(describe(action))
+
+            if not actions:
+                debug('Nothing to do.')
+            elif '--dry-run' not in opts:
+                k = weo.trace.connect('krb5_pool', wics_krb5_pool)
+                apply(l, k, actions)
+
+            exit_with_msg('Failed to sweep some members :(',
+                          'Sweep finished with %d changes.' %
+                          (0 if '--dry-run' in opts else len(actions)))
+
+    if '--refresh-cache' in opts:
+        from weo.cache import wics_cache
+
+        c = wics_cache()
+        l = open_ldap()
+        try:
+            c.refresh(l, full='--full' in opts)
+        except:
+            print_exc(sys.exc_info())
+
+        exit_with_msg('Failed to refresh the cache :(',
+                      'Cache successfully refreshed.')
+
+    if '--export-snapshot' in opts:
+        from weo.snapshot import write_snapshot
+
+        l = open_ldap()
+        try:
+            (users, groups) = write_snapshot(l, opts['--export-snapshot'])
+            debug('Wrote %d users and %d groups.' % (users, groups))
+        except:
+            print_exc(sys.exc_info())
+
+        exit_with_msg('Failed to export a snapshot :(',
+                      'Snapshot successfully exported.')
+
+    if '--show-user' in opts or '--show-group' in opts:
+        from weo.cache import wics_cache
+
+        c = wics_cache()
+        name = opts.get('--show-user') or opts.get('--show-group')
+        if '--show-user' in opts:
+            found = (c.get_user_by_uidnumber(int(name)) if name.isdigit()
+                     else c.get_user(name))
+        else:
+            found = (c.get_group_by_gidnumber(int(name)) if name.isdigit()
+                     else c.get_group(name))
+
+        if found is None:
+            error('Not found in the cache.')
+            sys.exit(1)
+        for (key, value) in sorted(found.items()):
+            if isinstance(value, list):
+                value = ' '.join(value)
+            print '%s: %s' % (key, value)
+        sys.exit(0)
+
+    if '--id-report' in opts or '--repair-counters' in opts:
+        from weo.idindex import id_index
+
+        l = open_ldap()
+        index = id_index(l)
+        for line in index.report():
+            print line
+
+        if '--repair-counters' in opts and '--dry-run' not in opts:
+            fixed = index.repair(l)
+            exit_with_msg('Failed to repair some counters :(',
+                          'Repaired %d counters.' % fixed)
+        sys.exit(0)
+
     if '--unlock-nextuid' in opts:
-        l = wics_ldap()
+        from weo.ldap import BASE
+        l = open_ldap()
         l.unlock('uid=inuse,ou=People,' + BASE, 'uid=nextuid')
         sys.exit(0)
 
     if '--unlock-nextgid' in opts:
-        l = wics_ldap()
+        from weo.ldap import BASE
+        l = open_ldap()
         l.unlock('cn=inuse,ou=Group,' + BASE, 'cn=nextgid')
         sys.exit(0)
 
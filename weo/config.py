@@ -0,0 +1,114 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import ConfigParser
+import os
+
+# Config files, read in order so later ones win. WEO_CONFIG names an extra
+# one to read last.
+CONFIG_PATHS = ['/etc/weo.conf', os.path.expanduser('~/.weo.conf')]
+
+# Built-in settings, by section and option
+DEFAULTS = {
+    'ldap': {
+        'primary': 'ldaps://auth1.wics.uwaterloo.ca',
+        'replicas': '',
+        'uw': 'ldap://ldap.uwaterloo.ca',
+        'uw_base': 'dc=uwaterloo,dc=ca',
+        'uw_cache_ttl': '604800',
+        'base': 'dc=wics,dc=uwaterloo,dc=ca',
+        'connect_timeout': '3',
+        'timeout': '30',
+        'max_rate': '0',
+    },
+    'kerberos': {
+        'realm': 'WICS.UWATERLOO.CA',
+        'admin': 'sysadmin/admin',
+        'max_rate': '0',
+    },
+    'postprov': {
+        'enabled': 'no',
+        'skel': '/etc/skel',
+        'home_mode': '0700',
+        'workers': '8',
+        'hooks': '',
+        'plugins': '',
+    },
+}
+
+# Environment variables that override settings, e.g. for one-off runs
+# against a test server
+ENVIRONMENT = {
+    'WEO_LDAP_PRIMARY': ('ldap', 'primary'),
+    'WEO_LDAP_REPLICAS': ('ldap', 'replicas'),
+    'WEO_UW_LDAP': ('ldap', 'uw'),
+    'WEO_UW_BASE': ('ldap', 'uw_base'),
+    'WEO_LDAP_BASE': ('ldap', 'base'),
+    'WEO_LDAP_CONNECT_TIMEOUT': ('ldap', 'connect_timeout'),
+    'WEO_LDAP_TIMEOUT': ('ldap', 'timeout'),
+    'WEO_REALM': ('kerberos', 'realm'),
+    'WEO_KRB_ADMIN': ('kerberos', 'admin'),
+    'WEO_LDAP_MAX_RATE': ('ldap', 'max_rate'),
+    'WEO_KRB_MAX_RATE': ('kerberos', 'max_rate'),
+    'WEO_POST_PROVISION': ('postprov', 'enabled'),
+}
+
+
+def load():
+    '''
+    Reads the weo config files and environment overrides on top of the
+    built-in defaults.
+
+    Returns a ConfigParser.
+    '''
+    config = ConfigParser.RawConfigParser()
+    for (section, options) in DEFAULTS.items():
+        config.add_section(section)
+        for (option, value) in options.items():
+            config.set(section, option, value)
+
+    paths = list(CONFIG_PATHS)
+    if os.environ.get('WEO_CONFIG'):
+        paths.append(os.environ['WEO_CONFIG'])
+    config.read(paths)
+
+    for (var, (section, option)) in ENVIRONMENT.items():
+        if var in os.environ:
+            config.set(section, option, os.environ[var])
+
+    return config
+
+
+CONFIG = load()
+
+
+def get(section, option):
+    "Returns the setting 'option' in 'section'."
+    return CONFIG.get(section, option)
+
+
+def get_list(section, option):
+    "Returns the whitespace- or comma-separated setting as a list."
+    return CONFIG.get(section, option).replace(',', ' ').split()
+
+
+def get_float(section, option):
+    "Returns the setting 'option' in 'section' as a number."
+    return CONFIG.getfloat(section, option)
+
+
+def get_boolean(section, option):
+    "Returns the setting 'option' in 'section' as a boolean, e.g. yes or no."
+    return CONFIG.getboolean(section, option)
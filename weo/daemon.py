@@ -0,0 +1,237 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import getpass
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import weo.krb5
+import weo.log
+import weo.postprov
+import weo.trace
+
+from weo.krb5 import wics_krb5
+from weo.log import debug, error, print_exc
+from weo.provision import provision_user
+from weo.utils import check_username, to_utf8
+
+# Where `weo --serve` listens by default
+SOCKET_PATH = '/var/run/weo/weo.sock'
+
+
+class wics_session(object):
+    '''
+    Long-lived LDAP and Kerberos connections for the daemon. Each connection
+    is opened on first use and reopened after it fails. Clients are served
+    on their own threads, but take 'lock' to run a request, so requests
+    still run one at a time on the shared connections.
+    '''
+
+    def __init__(self, krb_password=None):
+        self.krb_password = krb_password
+        self.lock = threading.Lock()
+        self._ldap = None
+        self._krb5 = None
+
+    @property
+    def ldap(self):
+        if self._ldap is None:
+            from weo.ldap import wics_ldap
+
+            debug('Opening LDAP connection...')
+            self._ldap = weo.trace.connect('ldap', wics_ldap)
+        return self._ldap
+
+    @property
+    def krb5(self):
+        if self._krb5 is None:
+            debug('Opening Kerberos admin connection...')
+            self._krb5 = weo.trace.connect('krb5', wics_krb5,
+                                           password=self.krb_password)
+        return self._krb5
+
+    def check(self):
+        '''
+        Makes sure our connections still work after a failed request, dropping
+        any that don't so they are reopened for the next one.
+        '''
+        if self._ldap is not None:
+            try:
+                self._ldap.ldap_wics.whoami_s()
+            except Exception:
+                debug('LDAP connection is dead, will reconnect.')
+                self._ldap = None
+
+        # kadmin gives us no cheap liveness check, so start afresh
+        self._krb5 = None
+
+
+# Request handlers, by command name. Each takes the session and the decoded
+# request, and reports failure through weo.log.error.
+
+def _adduser(session, req):
+    uid = check_username(req['username'])
+    if (provision_user(session.ldap, session.krb5, uid, req['fullname'],
+                       req['password']) and weo.postprov.ENABLED):
+        weo.postprov.post_provision(session.ldap, [uid])
+
+
+def _add_ldap_user(session, req):
+    session.ldap.add_user(check_username(req['username']), req['fullname'])
+
+
+def _add_krb_princ(session, req):
+    session.krb5.add_princ(check_username(req['username']),
+                           password=req['password'])
+
+
+def _addgroup(session, req):
+    session.ldap.add_group(check_username(req['groupname'], maxlen=10),
+                           req['groupdesc'])
+
+
+def _add_user_to_group(session, req):
+    session.ldap.add_user_to_group(req['groupname'], req['username'])
+
+
+def _remove_user_from_group(session, req):
+    session.ldap.remove_user_from_group(req['groupname'], req['username'])
+
+
+def _renew(session, req):
+    session.ldap.renew_user(req['username'], num_terms=req.get('num_terms'))
+
+
+HANDLERS = {
+    'adduser': _adduser,
+    'add-ldap-user': _add_ldap_user,
+    'add-krb-princ': _add_krb_princ,
+    'addgroup': _addgroup,
+    'add-user-to-group': _add_user_to_group,
+    'remove-user-from-group': _remove_user_from_group,
+    'renew': _renew,
+}
+
+
+def handle(session, req):
+    '''
+    Runs a single request against the session.
+
+    Returns a response dict with 'ok' and, on failure, a list of 'errors'.
+    '''
+    handler = HANDLERS.get(req.get('command'))
+    if handler is None:
+        return {'ok': False,
+                'errors': ['Unknown command %s' % req.get('command')]}
+
+    weo.log.DAS_ERROR = False
+    weo.log.CAPTURE = []
+    try:
+        handler(session, req)
+    except KeyError as e:
+        error('Missing parameter %s' % e)
+    except Exception:
+        print_exc(sys.exc_info())
+    finally:
+        errors = weo.log.CAPTURE
+        weo.log.CAPTURE = None
+
+    if errors:
+        session.check()
+    return {'ok': not errors, 'errors': errors}
+
+
+class _handler(SocketServer.StreamRequestHandler):
+    'Serves newline-delimited JSON requests on one client connection'
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                # python-ldap wants str, not the unicode JSON gives us
+                req = to_utf8(json.loads(line))
+            except ValueError:
+                resp = {'ok': False, 'errors': ['Malformed request']}
+            else:
+                debug('Request: %s' % req.get('command'))
+                with self.server.session.lock:
+                    resp = handle(self.server.session, req)
+            self.wfile.write(json.dumps(resp) + '\n')
+            self.wfile.flush()
+
+
+def serve(path=None):
+    '''
+    Runs the weo daemon, answering requests on a Unix socket until killed.
+    Each client gets its own thread, so an idle one doesn't hold up the
+    rest, but requests are handled one at a time, so they share one set of
+    warm connections.
+
+    path: (optional) the socket path; defaults to SOCKET_PATH
+    '''
+    path = path or SOCKET_PATH
+    password = None
+    if weo.krb5.KRB_KEYTAB is None:
+        password = getpass.getpass('Enter Kerberos admin password: ')
+    session = wics_session(password)
+
+    # Connect up front, so a bad password is caught before we start serving
+    session.ldap
+    session.krb5
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Only root may talk to us, from the moment the socket exists: it
+    # carries admin LDAP/Kerberos credentials
+    umask = os.umask(0077)
+    try:
+        server = SocketServer.ThreadingUnixStreamServer(path, _handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.session = session
+
+    debug('Listening on %s' % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def call(req, path=None):
+    '''
+    Sends a request to a running weo daemon and returns its response.
+
+    req: the request, a dict with a 'command' key and its parameters
+    path: (optional) the socket path; defaults to SOCKET_PATH
+    '''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or SOCKET_PATH)
+        f = sock.makefile('r+b')
+        f.write(json.dumps(req) + '\n')
+        f.flush()
+        return json.loads(f.readline())
+    finally:
+        sock.close()
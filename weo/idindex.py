@@ -0,0 +1,264 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import bisect
+import ldap
+
+from weo.log import debug, error
+
+# New users take their UID and GID from the counter on nextuid, and new
+# groups take their GID from the counter on nextgid. Nothing stops failed
+# adds, rollbacks or hand edits from leaving a counter behind numbers that
+# are already in use, or from giving two entries the same number, so this
+# module reads every number in use into an interval index to find out.
+#
+# Gaps below a counter are only reported, never handed out again: a gap may
+# have belonged to a deleted member whose files are still around, or be a
+# block an interrupted batch's journal still holds for when it resumes.
+
+# How many gaps to list in a report
+REPORT_GAPS = 10
+
+
+class interval_index(object):
+    '''
+    A set of integers, stored as sorted, disjoint, inclusive intervals so
+    that the runs of consecutive IDs a directory is mostly made of take
+    almost no space, and gaps can be found by bisection.
+    '''
+
+    def __init__(self, numbers=()):
+        self.starts = []
+        self.ends = []
+        for n in sorted(set(numbers)):
+            if self.ends and self.ends[-1] == n - 1:
+                self.ends[-1] = n
+            else:
+                self.starts.append(n)
+                self.ends.append(n)
+
+    def __contains__(self, n):
+        i = bisect.bisect_right(self.starts, n) - 1
+        return i >= 0 and n <= self.ends[i]
+
+    def __len__(self):
+        return sum(end - start + 1
+                   for (start, end) in zip(self.starts, self.ends))
+
+    def intervals(self):
+        "Returns the (start, end) intervals in the index, in order."
+        return zip(self.starts, self.ends)
+
+    def max(self):
+        return self.ends[-1] if self.ends else None
+
+    def add(self, n):
+        "Adds the number 'n', merging it into the intervals either side."
+        if n in self:
+            return
+        i = bisect.bisect_left(self.starts, n)
+        joins_prev = i > 0 and self.ends[i - 1] == n - 1
+        joins_next = i < len(self.starts) and self.starts[i] == n + 1
+        if joins_prev and joins_next:
+            self.ends[i - 1] = self.ends[i]
+            del self.starts[i]
+            del self.ends[i]
+        elif joins_prev:
+            self.ends[i - 1] = n
+        elif joins_next:
+            self.starts[i] = n
+        else:
+            self.starts.insert(i, n)
+            self.ends.insert(i, n)
+
+    def next_used(self, n):
+        '''
+        Returns a tuple (start, end) of the first interval that includes or
+        follows 'n', or None if there isn't one.
+        '''
+        i = bisect.bisect_left(self.ends, n)
+        if i == len(self.ends):
+            return None
+        return (self.starts[i], self.ends[i])
+
+    def gaps(self, lo, hi):
+        "Yields the (start, end) ranges between 'lo' and 'hi' not in use."
+        n = lo
+        while n <= hi:
+            used = self.next_used(n)
+            if used is None or used[0] > hi:
+                yield (n, hi)
+                return
+            if used[0] > n:
+                yield (n, used[0] - 1)
+            n = used[1] + 1
+
+
+class id_index(object):
+    '''
+    The UID and GID numbers in use in the WiCS LDAP DB, and the counters that
+    hand out new ones, read in one paged scan of each of ou=People and
+    ou=Group.
+    '''
+
+    def __init__(self, l):
+        '''
+        l: an open wics_ldap; reads go to the primary, so that numbers
+            handed out moments ago aren't missed
+        '''
+        from weo.ldap import BASE
+
+        self.nextuid_dn = 'uid=nextuid,ou=People,' + BASE
+        self.nextgid_dn = 'cn=nextgid,ou=Group,' + BASE
+
+        # Which entries hold each number, and the counters' values
+        uid_owners = {}
+        gid_owners = {}
+        self.counters = {}
+        users = set()
+        personal_gids = []
+        group_gids = []
+
+        debug('Scanning UID and GID numbers...')
+        for (dn, entry) in l.search_paged(
+                'ou=People,' + BASE, '(uidNumber=*)',
+                ['uid', 'uidNumber', 'gidNumber'], primary=True):
+            rdn = dn.split(',', 1)[0].lower()
+            if rdn in ('uid=nextuid', 'uid=inuse'):
+                self.counters[self.nextuid_dn] = dict(
+                    (attr, int(entry[attr][0]))
+                    for attr in ('uidNumber', 'gidNumber') if attr in entry)
+                continue
+            uid_owners.setdefault(int(entry['uidNumber'][0]), []).append(dn)
+            users.add(rdn.split('=', 1)[1])
+
+        for (dn, entry) in l.search_paged(
+                'ou=Group,' + BASE, '(gidNumber=*)', ['cn', 'gidNumber'],
+                primary=True):
+            rdn = dn.split(',', 1)[0].lower()
+            gid = int(entry['gidNumber'][0])
+            if rdn in ('cn=nextgid', 'cn=inuse'):
+                self.counters[self.nextgid_dn] = {'gidNumber': gid}
+                continue
+            gid_owners.setdefault(gid, []).append(dn)
+            if rdn.split('=', 1)[1] in users:
+                personal_gids.append(gid)
+            else:
+                group_gids.append(gid)
+
+        self.uids = interval_index(uid_owners)
+        self.gids = interval_index(gid_owners)
+        self.collisions = {
+            'uidNumber': dict((n, dns) for (n, dns) in uid_owners.items()
+                              if len(dns) > 1),
+            'gidNumber': dict((n, dns) for (n, dns) in gid_owners.items()
+                              if len(dns) > 1),
+        }
+        self.max_user = max(list(uid_owners) + personal_gids or [None])
+        self.max_group = max(group_gids or [None])
+        debug('Found %d UIDs and %d GIDs in use.' %
+              (len(self.uids), len(self.gids)))
+
+    def counter_fixes(self):
+        '''
+        Works out which counters are behind numbers already in use, or have
+        a UID and GID out of step, and where they should be.
+
+        Returns a list of (dn, attr, current, wanted) tuples.
+        '''
+        fixes = []
+        nextuid = self.counters.get(self.nextuid_dn)
+        if nextuid:
+            # Both halves move together, to the first number past every user
+            # and personal group
+            wanted = max(list(nextuid.values()) +
+                         [(self.max_user or 0) + 1])
+            for (attr, current) in sorted(nextuid.items()):
+                if current != wanted:
+                    fixes.append((self.nextuid_dn, attr, current, wanted))
+
+        nextgid = self.counters.get(self.nextgid_dn)
+        if nextgid and self.max_group is not None and \
+                nextgid['gidNumber'] <= self.max_group:
+            fixes.append((self.nextgid_dn, 'gidNumber', nextgid['gidNumber'],
+                          self.max_group + 1))
+        return fixes
+
+    def report(self):
+        "Returns lines describing the counters, collisions and gaps."
+        lines = []
+        for dn in (self.nextuid_dn, self.nextgid_dn):
+            if dn not in self.counters:
+                lines.append('%s: missing, or locked' % dn)
+                continue
+            for (attr, value) in sorted(self.counters[dn].items()):
+                index = self.uids if attr == 'uidNumber' else self.gids
+                used = index.next_used(value)
+                lines.append('%s: %s %d, %s' % (
+                    dn, attr, value, 'free from there on' if used is None
+                    else 'next in use is %d' % used[0]))
+
+        for fix in self.counter_fixes():
+            lines.append('%s: %s should be %d, not %d' %
+                         (fix[0], fix[1], fix[3], fix[2]))
+
+        for (attr, collisions) in sorted(self.collisions.items()):
+            for (n, dns) in sorted(collisions.items()):
+                lines.append('collision: %s %d is used by %s' %
+                             (attr, n, ', '.join(sorted(dns))))
+
+        for (attr, index) in (('uidNumber', self.uids),
+                              ('gidNumber', self.gids)):
+            if not index.starts:
+                continue
+            gaps = list(index.gaps(index.starts[0], index.max()))
+            lines.append('%s: %d in use between %d and %d, %d unused in %d '
+                         'gaps' % (attr, len(index), index.starts[0],
+                                   index.max(),
+                                   sum(end - start + 1
+                                       for (start, end) in gaps),
+                                   len(gaps)))
+            gaps.sort(key=lambda gap: gap[0] - gap[1])
+            for (start, end) in gaps[:REPORT_GAPS]:
+                lines.append('  unused %s: %d-%d (%d)' %
+                             (attr, start, end, end - start + 1))
+        return lines
+
+    def repair(self, l):
+        '''
+        Moves the counters found by counter_fixes to where they should be.
+        Each one is moved with a compare-and-swap modify, so a counter that
+        someone else moves in the meantime is left alone.
+
+        l: an open wics_ldap
+        Returns the number of counters fixed.
+        '''
+        fixed = 0
+        for (dn, attr, current, wanted) in self.counter_fixes():
+            try:
+                l.ldap_wics.modify_s(dn, [
+                    (ldap.MOD_DELETE, attr, str(current)),
+                    (ldap.MOD_ADD, attr, str(wanted))])
+                debug('%s: moved %s from %d to %d' %
+                      (dn, attr, current, wanted))
+                self.counters[dn][attr] = wanted
+                fixed += 1
+            except (ldap.NO_SUCH_ATTRIBUTE, ldap.NO_SUCH_OBJECT):
+                error('%s: %s changed while we were looking, or is locked; '
+                      'not moved' % (dn, attr))
+        return fixed
@@ -0,0 +1,125 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+
+from weo.log import debug
+
+# Batch steps, recorded against a key (usually a user id) as one of
+# these states
+INTENT = 'intent'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class wics_journal(object):
+    '''
+    An append-only journal of the steps of a batch: allocating IDs, adding
+    users and principals, renewing terms. Each step is recorded as intended
+    before it is attempted and as done once it has succeeded, so a batch
+    that is interrupted and rerun with the same journal can skip what it
+    already did, and knows exactly which steps may be half-finished.
+
+    Records are one JSON object per line. They are buffered until sync(),
+    which writes them out and fsyncs the file.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        path: (optional) the journal file, which is created if need be and
+            replayed if it already exists; with no path, the journal is only
+            kept in memory
+        '''
+        self.path = path
+        self._steps = {}
+        self._buffer = []
+        self._file = None
+
+        if path is None:
+            return
+
+        if os.path.exists(path):
+            with open(path, 'r+') as f:
+                good = 0
+                for line in iter(f.readline, ''):
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        rec = None
+                    if rec is None or not line.endswith('\n'):
+                        break  # torn final write from a crash
+                    self._steps[(rec['key'], rec['step'])] = (
+                        rec['state'], rec.get('data') or {})
+                    good = f.tell()
+                # Cut off the torn write, so new records don't run into it
+                f.truncate(good)
+            debug('Resuming from journal %s: %d steps done.' %
+                  (path, len(self.done())))
+
+        self._file = open(path, 'a')
+
+    def _record(self, key, step, state, data):
+        self._steps[(key, step)] = (state, data)
+        self._buffer.append(json.dumps({
+            'time': time.time(), 'key': key, 'step': step, 'state': state,
+            'data': data}, sort_keys=True))
+
+    def intend(self, key, step, **data):
+        "Records that we're about to attempt 'step' for 'key'."
+        self._record(key, step, INTENT, data)
+
+    def complete(self, key, step, **data):
+        "Records that 'step' for 'key' succeeded, with any results in 'data'."
+        self._record(key, step, DONE, data)
+
+    def fail(self, key, step, **data):
+        "Records that 'step' for 'key' failed, so a rerun should retry it."
+        self._record(key, step, FAILED, data)
+
+    def sync(self):
+        "Writes out everything recorded so far and waits for it to hit disk."
+        if self._file is not None and self._buffer:
+            self._file.write('\n'.join(self._buffer) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._buffer = []
+
+    def state(self, key, step):
+        "Returns the last recorded state of 'step' for 'key', or None."
+        return self._steps.get((key, step), (None, None))[0]
+
+    def is_done(self, key, step):
+        return self.state(key, step) == DONE
+
+    def is_pending(self, key, step):
+        "Whether 'step' for 'key' was attempted but never finished."
+        return self.state(key, step) == INTENT
+
+    def data(self, key, step):
+        "Returns the data recorded with the last state of 'step' for 'key'."
+        return self._steps.get((key, step), (None, {}))[1]
+
+    def done(self):
+        "Returns the (key, step) pairs that have been completed."
+        return [ks for (ks, (state, _)) in self._steps.items()
+                if state == DONE]
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
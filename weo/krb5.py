@@ -14,36 +14,234 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import getpass
-import kadmin
+import os
+import Queue
+import threading
 
-from weo.log import debug
+from weo import config
+from weo.log import debug, verbose
+from weo.stats import instrumented, timed
+from weo.throttle import aimd_throttle
 from weo.utils import get_user_password
 
-# Kerberos-specific info
-REALM = 'WICS.UWATERLOO.CA'
-KRB_ADMIN = 'sysadmin/admin'
+# Kerberos-specific info; see weo.config for how to override these
+REALM = config.get('kerberos', 'realm')
+KRB_ADMIN = config.get('kerberos', 'admin')
+
+# If set, admin sessions authenticate with this keytab rather than prompting
+# for a password
+KRB_KEYTAB = os.environ.get('WEO_KEYTAB')
+
+# How many kadmin sessions a wics_krb5_pool opens by default
+POOL_SIZE = 4
+
+# Most principals a wics_krb5_pool adds per second, or 0 for no limit
+MAX_RATE = config.get_float('kerberos', 'max_rate')
+
+
+def is_duplicate(e):
+    "Whether the kadmin exception 'e' means the principal already exists."
+    # Checked by name, as kadmin is only imported once a session is opened
+    return type(e).__name__ == 'DuplicateError'
 
 
 class wics_krb5(object):
     'Kerberos interface for the WiCS Kerberos Realm'
 
-    def __init__(self):
+    def __init__(self, password=None, keytab=None):
+        '''
+        password: (optional) the Kerberos admin password
+        keytab: (optional) a keytab for the admin principal; defaults to
+            KRB_KEYTAB. If neither a password nor a keytab is available the
+            user will be prompted for the password.
+        '''
+        keytab = keytab or KRB_KEYTAB
+        if password is None and keytab is None:
+            password = getpass.getpass('Enter Kerberos admin password: ')
+
+        # Imported here so that loading this module, e.g. for REALM, is cheap
+        import kadmin
+        kadmin = instrumented(kadmin, 'kadmin')
+
         # Open Kerberos admin connection
-        self.krb_wics = kadmin.init_with_password(
-            '%s@%s' % (KRB_ADMIN, REALM),
-            getpass.getpass('Enter Kerberos admin password: '))
+        if password is None:
+            conn = kadmin.init_with_keytab(
+                '%s@%s' % (KRB_ADMIN, REALM), keytab)
+        else:
+            conn = kadmin.init_with_password(
+                '%s@%s' % (KRB_ADMIN, REALM), password)
+        self.krb_wics = instrumented(conn, 'kadmin')
 
-    def add_princ(self, uid, password=None):
+    def add_princ(self, uid, password=None, random_key=False):
         '''
         Adds a Kerberos principal.
 
         uid: the user id for the principal
         password: (optional) a string consisting of the user's password; if no
             string is provided the user will be prompted to enter one
+        random_key: (optional) give the principal a random key instead of a
+            password
         '''
-        if password is None:
+        if password is None and not random_key:
             password = get_user_password(
                 'Enter password for principal %s@%s: ' % (uid, REALM))
 
         debug('Adding Kerberos principal...')
+        # kadmin gives the principal a random key when the password is None
         self.krb_wics.addprinc('%s@%s' % (uid, REALM), password)
+
+    def add_princs(self, users):
+        '''
+        Adds many Kerberos principals, one after another.
+
+        users: a list of (uid, password) tuples; a password of None gives that
+            principal a random key
+        Returns a dict mapping each uid to None on success, or else the
+        exception that was raised.
+        '''
+        return self.run_each('add_princ', [
+            (uid, password, password is None) for (uid, password) in users])
+
+    def del_princ(self, uid):
+        '''
+        Deletes a Kerberos principal.
+
+        uid: the user id for the principal
+        '''
+        debug('Deleting Kerberos principal...')
+        self.krb_wics.delprinc('%s@%s' % (uid, REALM))
+
+    def lock_princ(self, uid):
+        '''
+        Locks a Kerberos principal by expiring it, so it can no longer get
+        tickets but can be unlocked again later.
+
+        uid: the user id for the principal
+        '''
+        debug('Locking Kerberos principal...')
+        princ = self.krb_wics.getprinc('%s@%s' % (uid, REALM))
+        if princ is None:
+            raise KeyError('no principal %s@%s' % (uid, REALM))
+        princ.expire = 'now'
+        with timed('kadmin.commit'):
+            princ.commit()
+
+    def del_princs(self, uids):
+        "Deletes many Kerberos principals, one after another."
+        return self.run_each('del_princ', [(uid,) for uid in uids])
+
+    def lock_princs(self, uids):
+        "Locks many Kerberos principals, one after another."
+        return self.run_each('lock_princ', [(uid,) for uid in uids])
+
+    def run_each(self, method, calls):
+        '''
+        Calls one of our methods for each of 'calls', one after another.
+
+        method: the name of the method, e.g. 'del_princ'
+        calls: a list of argument tuples, each starting with a uid
+        Returns a dict mapping each uid to None on success, or else the
+        exception that was raised.
+        '''
+        errors = {}
+        for args in calls:
+            try:
+                getattr(self, method)(*args)
+                errors[args[0]] = None
+            except Exception as e:
+                errors[args[0]] = e
+        return errors
+
+
+class wics_krb5_pool(object):
+    '''
+    A pool of kadmin sessions for creating principals in bulk. Each session
+    works through a shared queue on its own thread, so one slow addprinc
+    doesn't hold up the rest.
+    '''
+
+    def __init__(self, size=None, password=None, keytab=None):
+        '''
+        size: (optional) how many sessions to open; defaults to POOL_SIZE
+        password: (optional) the Kerberos admin password
+        keytab: (optional) a keytab for the admin principal, as for wics_krb5
+        '''
+        keytab = keytab or KRB_KEYTAB
+        if password is None and keytab is None:
+            # Ask once, rather than once per session
+            password = getpass.getpass('Enter Kerberos admin password: ')
+
+        self.sessions = [wics_krb5(password=password, keytab=keytab)
+                         for x in range(size or POOL_SIZE)]
+        # Sessions only get to work while the KDC is keeping up
+        self.throttle = aimd_throttle(len(self.sessions), rate=MAX_RATE,
+                                      name='kadmin')
+
+    def add_princ(self, uid, password=None, random_key=False):
+        "Adds a single Kerberos principal, as wics_krb5.add_princ does."
+        self.sessions[0].add_princ(uid, password, random_key)
+
+    def del_princ(self, uid):
+        "Deletes a Kerberos principal, as wics_krb5.del_princ does."
+        self.sessions[0].del_princ(uid)
+
+    def lock_princ(self, uid):
+        "Locks a Kerberos principal, as wics_krb5.lock_princ does."
+        self.sessions[0].lock_princ(uid)
+
+    def add_princs(self, users):
+        '''
+        Adds many Kerberos principals, spread across the pool's sessions.
+
+        users: a list of (uid, password) tuples; a password of None gives that
+            principal a random key
+        Returns a dict mapping each uid to None on success, or else the
+        exception that was raised.
+        '''
+        return self.run_each('add_princ', [
+            (uid, password, password is None) for (uid, password) in users])
+
+    def del_princs(self, uids):
+        "Deletes many Kerberos principals, spread across the pool's sessions."
+        return self.run_each('del_princ', [(uid,) for uid in uids])
+
+    def lock_princs(self, uids):
+        "Locks many Kerberos principals, spread across the pool's sessions."
+        return self.run_each('lock_princ', [(uid,) for uid in uids])
+
+    def run_each(self, method, calls):
+        '''
+        Calls one of wics_krb5's methods for each of 'calls', spread across
+        the pool's sessions.
+
+        method: the name of the method, e.g. 'del_princ'
+        calls: a list of argument tuples, each starting with a uid
+        Returns a dict mapping each uid to None on success, or else the
+        exception that was raised.
+        '''
+        work = Queue.Queue()
+        for args in calls:
+            work.put(args)
+
+        errors = {}
+
+        def worker(session):
+            while True:
+                try:
+                    args = work.get_nowait()
+                except Queue.Empty:
+                    return
+                started = self.throttle.acquire()
+                verbose('kadmin session %d: %s %s' %
+                        (id(session), method, args[0]))
+                errors.update(session.run_each(method, [args]))
+                self.throttle.release(started, errors[args[0]])
+
+        threads = [threading.Thread(target=worker, args=(session,))
+                   for session in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return errors
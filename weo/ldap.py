@@ -16,62 +16,208 @@
 from __future__ import absolute_import
 
 
-import datetime
+import calendar
 import getpass
 import ldap
+import ldap.dn
+import ldap.filter
 import ldap.modlist as modlist
 import ldap.sasl
+import os
+import random
+import socket
 import sys
+import threading
 import time
 
-from dateutil.relativedelta import relativedelta
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.readentry import PostReadControl
+from weo import config
 from weo.log import debug, error, print_exc, verbose
-from weo.utils import get_term
+from weo.pipeline import ldap_pipeline
+from weo.stats import instrumented, record
+from weo.utils import get_term, get_terms, term_range
 
-# Connection information
-LDAP_SERVER = 'ldaps://auth1.wics.uwaterloo.ca'
-UW_LDAP = 'ldap://ldap.uwaterloo.ca'
+# Connection information; see weo.config for how to override these
+LDAP_SERVER = config.get('ldap', 'primary')
+LDAP_REPLICAS = config.get_list('ldap', 'replicas')
+UW_LDAP = config.get('ldap', 'uw')
+UW_BASE = config.get('ldap', 'uw_base')
+
+# The UW directory keeps a student's program in 'ou'
+UW_PROGRAM_ATTR = 'ou'
 
 # LDAP-specific info
-BASE = 'dc=wics,dc=uwaterloo,dc=ca'
+BASE = config.get('ldap', 'base')
 LDAP_ADMIN = 'cn=root,' + BASE
 
-# Timeout and retry values
-NUM_TRIES = 3
-SLEEP_DUR = 5
+# How long to wait for a server to accept a connection, and for any single
+# operation, in seconds, and how many times to try connecting to the primary
+CONNECT_TIMEOUT = config.get_float('ldap', 'connect_timeout')
+OP_TIMEOUT = config.get_float('ldap', 'timeout')
+CONNECT_TRIES = 3
+
+# ID allocation strategy: 'increment' tries RFC 4525 modify-increment
+# first, 'cas' uses compare-and-swap modifies, 'lock' uses the modrdn lock
+ALLOCATOR = 'increment'
+
+# Timeout and retry values, in seconds
+LOCK_TIMEOUT = 15
+LOCK_BACKOFF_MIN = 0.02
+LOCK_BACKOFF_MAX = 2
+CAS_TRIES = 10
+
+# How many values to put in a single OR filter
+FILTER_CHUNK = 200
+
+# How many entries to ask for per page of search results
+PAGE_SIZE = 500
+
+# How many uniqueMember values to change in a single modify
+MEMBER_CHUNK = 1000
+
+# A lock whose lease is older than this is assumed to have been abandoned
+LEASE_DUR = 60
+LEASE_PREFIX = 'weo-lease:'
+
+
+def normalize_dn(dn):
+    "Returns 'dn' in a canonical form, so that equal DNs compare equal."
+    return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
 
 
 class wics_ldap(object):
     'LDAP interface for the WiCS LDAP DB'
 
     def __init__(self):
-        # Open LDAP connection
-        self.ldap_wics = ldap.initialize(LDAP_SERVER)
-        self.ldap_uw = ldap.initialize(UW_LDAP)  # FIXME: currently unused
-
+        # Open LDAP connection to the primary, which takes all writes. Reads
+        # that can tolerate replication lag go to ldap_read instead.
+        self.ldap_wics = self._connect_primary()
+        self._ldap_read = None
+        self._ldap_uw = None
+
+        # Cleared if the server turns out not to support modify-increment
+        self.increment_supported = True
+
+        # Leases we hold, by lock DN, and how long each lock() waited
+        self._leases = {}
+        self.lock_waits = []
+        self._throttle = None
+
+    def bind(self, conn):
+        "Authenticates a connection 'conn' to the WiCS LDAP DB."
         # FIXME: This gives admin access for all the things; fine for now, will
         # not be fine later.
         auth = ldap.sasl.gssapi("")
-        self.ldap_wics.sasl_interactive_bind_s("", auth)
+        conn.sasl_interactive_bind_s("", auth)
+
+    def _open(self, uri, name='ldap'):
+        "Opens a connection to 'uri' with our timeouts, without binding."
+        conn = ldap.initialize(uri)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, CONNECT_TIMEOUT)
+        conn.set_option(ldap.OPT_TIMEOUT, OP_TIMEOUT)
+        conn.timeout = OP_TIMEOUT
+        return instrumented(conn, name)
+
+    def _connect_primary(self):
+        "Connects and binds to the primary, retrying quickly if it fails."
+        for x in range(CONNECT_TRIES):
+            try:
+                conn = self._open(LDAP_SERVER)
+                self.bind(conn)
+                return conn
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT):
+                if x == CONNECT_TRIES - 1:
+                    raise
+                debug('Could not reach %s, retrying...' % LDAP_SERVER)
+                time.sleep(random.uniform(0, LOCK_BACKOFF_MIN * 2 ** x))
+
+    def _probe(self, uri, latencies):
+        "Times a root DSE read from 'uri', recording it in 'latencies'."
+        try:
+            conn = self._open(uri)
+            start = time.time()
+            conn.search_s('', ldap.SCOPE_BASE, attrlist=['1.1'])
+            latencies[uri] = (time.time() - start, conn)
+        except ldap.LDAPError as e:
+            verbose('Replica %s is unhealthy: %s' % (uri, e))
+
+    @property
+    def ldap_read(self):
+        '''
+        A connection for reads: the fastest healthy replica, chosen by timing
+        a root DSE read from each of them at once, or else the primary.
+        '''
+        if self._ldap_read is None:
+            latencies = {}
+            probes = [threading.Thread(target=self._probe,
+                                       args=(uri, latencies))
+                      for uri in LDAP_REPLICAS]
+            for probe in probes:
+                probe.start()
+            for probe in probes:
+                probe.join(CONNECT_TIMEOUT + OP_TIMEOUT)
+
+            for (uri, (latency, conn)) in sorted(latencies.items(),
+                                                 key=lambda x: x[1][0]):
+                try:
+                    self.bind(conn)
+                except ldap.LDAPError as e:
+                    verbose('Could not bind to replica %s: %s' % (uri, e))
+                    continue
+                verbose('Reading from %s (%.1fms)' % (uri, 1000 * latency))
+                self._ldap_read = conn
+                break
+            else:
+                self._ldap_read = self.ldap_wics
+
+        return self._ldap_read
+
+    @property
+    def ldap_uw(self):
+        "The UW LDAP connection, opened on first use"
+        if self._ldap_uw is None:
+            self._ldap_uw = self._open(UW_LDAP, 'uwldap')
+        return self._ldap_uw
 
     def lock(self, dn, newdn):
         '''
         This helper performs a simple atomic test and set lock using LDAP
-        attributes.
+        attributes. While the lock is held, a lease recording when and by whom
+        it was taken is kept in the entry's description, so that a lock left
+        behind by a crashed process can be broken once the lease expires.
 
         dn: the distinguished name of our mutex object
         newdn: new distinguished name object, e.g. "cn=newuid"
+        Returns the number of seconds spent waiting for the lock.
         '''
         debug('Locking LDAP database...')
-        for x in range(NUM_TRIES):
+        lockdn = newdn + ',' + dn.split(',', 1)[1]
+        start = time.time()
+        delay = LOCK_BACKOFF_MIN
+
+        while True:
             try:
                 self.ldap_wics.modrdn_s(dn, newdn)
-                return
-            except:
-                print_exc(sys.exc_info())
-                time.sleep(SLEEP_DUR)
-
-        raise ldap.TIMEOUT('Could not obtain lock on ' + dn)
+                self._take_lease(lockdn)
+                break
+            except ldap.NO_SUCH_OBJECT:
+                # Somebody else holds it; make sure they're still alive
+                if self._break_stale_lock(lockdn):
+                    break
+
+            if time.time() - start > LOCK_TIMEOUT:
+                raise ldap.TIMEOUT('Could not obtain lock on ' + dn)
+
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, LOCK_BACKOFF_MAX)
+
+        waited = time.time() - start
+        self.lock_waits.append(waited)
+        record('ldap.lock_wait', waited)
+        verbose('Waited %.3fs for lock on %s' % (waited, dn))
+        return waited
 
     def unlock(self, dn, newdn):
         '''
@@ -80,64 +226,264 @@ class wics_ldap(object):
         dn: the distinguished name of our mutex object
         newdn: new distinguished name object, e.g. "cn=newuid"
         '''
+        lease = self._leases.pop(dn, None)
+        if lease is not None:
+            try:
+                self.ldap_wics.modify_s(
+                    dn, [(ldap.MOD_DELETE, 'description', lease)])
+            except ldap.NO_SUCH_ATTRIBUTE:
+                # Our lease expired and somebody else took the lock over
+                error('Lock on %s was broken while we held it!' % dn)
+                return
+        else:
+            # Unlocking by hand, so clear whatever lease is there
+            self._clear_leases(dn)
+
         self.ldap_wics.modrdn_s(dn, newdn)
         debug('Unlocked database.')
 
-    def add_user(self, uid, username):
+    def _read_leases(self, dn):
+        "Returns the lock entry 'dn' and the lease values stored on it."
+        entry = self.ldap_wics.search_s(
+            dn, ldap.SCOPE_BASE,
+            attrlist=['description', 'modifyTimestamp'])[0][1]
+        leases = [value for value in entry.get('description', [])
+                  if value.startswith(LEASE_PREFIX)]
+        return (entry, leases)
+
+    def _clear_leases(self, dn):
+        "Removes any lease values from the lock entry 'dn'."
+        (_, leases) = self._read_leases(dn)
+        if leases:
+            self.ldap_wics.modify_s(
+                dn, [(ldap.MOD_DELETE, 'description', leases)])
+
+    def _take_lease(self, dn, stale=None):
         '''
-        Adds a user to the LDAP database.
+        Writes our lease onto the lock entry 'dn'. If 'stale' lease values are
+        given they are removed in the same modify, which fails if anyone else
+        has already replaced them.
+        '''
+        lease = '%s%f:%s:%d' % (LEASE_PREFIX, time.time(),
+                                socket.gethostname(), os.getpid())
+        ml = [(ldap.MOD_ADD, 'description', lease)]
+        if stale:
+            ml.insert(0, (ldap.MOD_DELETE, 'description', stale))
 
-        uid: the unique user id for our new user
-        username: the user's full name
+        self.ldap_wics.modify_s(dn, ml)
+        self._leases[dn] = lease
+
+    def _break_stale_lock(self, dn):
         '''
-        self.lock('uid=nextuid,ou=People,' + BASE, 'uid=inuse')
-        nextuid = self.ldap_wics.search_s(
-            'uid=inuse,ou=People,' + BASE,
-            ldap.SCOPE_BASE)
+        Takes over the lock entry 'dn' if its lease has expired.
+        Returns True if we now hold the lock.
+        '''
+        try:
+            (entry, leases) = self._read_leases(dn)
+        except ldap.NO_SUCH_OBJECT:
+            return False  # released while we were looking
+
+        if leases:
+            taken = float(leases[0][len(LEASE_PREFIX):].split(':')[0])
+        else:
+            # The holder died before writing a lease; fall back to when the
+            # entry was renamed
+            taken = calendar.timegm(time.strptime(
+                entry['modifyTimestamp'][0][:14], '%Y%m%d%H%M%S'))
+
+        if time.time() - taken < LEASE_DUR:
+            return False
+
+        debug('Breaking stale lock on %s (%s)' %
+              (dn, leases[0] if leases else 'no lease'))
+        try:
+            # Deleting the old lease makes this a compare-and-swap, so only
+            # one of several waiters can win. Without an old lease to compare
+            # against, two waiters could both take over; that needs a holder
+            # to have crashed in the window between its modrdn and its lease.
+            self._take_lease(dn, stale=leases)
+        except (ldap.NO_SUCH_ATTRIBUTE, ldap.NO_SUCH_OBJECT):
+            return False
 
-        nextuid_obj = nextuid[0][1]
-        next_uid = int(nextuid_obj['uidNumber'][0])
-        next_gid = int(nextuid_obj['gidNumber'][0])
+        return True
 
-        if next_uid != next_gid:
-            # This isn't enforced at the schema level but close enough
-            raise ldap.OBJECT_CLASS_VIOLATION(
-                "UID and GID on nextuid are out of sync. Tell the sysadmin!")
+    def allocate_ids(self, dn, attrs, count=1):
+        '''
+        Reserves 'count' consecutive values of each numeric attribute in
+        'attrs' from the counter entry 'dn', without taking the modrdn lock.
+        The counters are bumped with an atomic modify-increment (RFC 4525)
+        and read back with a post-read control; servers that refuse that get
+        a compare-and-swap modify instead. If the counter is currently
+        renamed to "inuse" by a lock holder, we fall back to the lock.
+
+        dn: the distinguished name of the counter, e.g. uid=nextuid,...
+        attrs: the counter attributes, e.g. ['uidNumber', 'gidNumber']
+        count: how many values to reserve
+        Returns a list of the first reserved value of each attribute.
+        '''
+        try:
+            if ALLOCATOR == 'lock':
+                return self._allocate_locked(dn, attrs, count)
+            if ALLOCATOR == 'increment' and self.increment_supported:
+                try:
+                    return self._allocate_increment(dn, attrs, count)
+                except (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                        ldap.UNWILLING_TO_PERFORM, ldap.PROTOCOL_ERROR):
+                    print_exc(sys.exc_info())
+                    debug('Server refused modify-increment, falling back '
+                          'to compare-and-swap.')
+                    self.increment_supported = False
+            return self._allocate_cas(dn, attrs, count)
+        except ldap.NO_SUCH_OBJECT:
+            # Someone is holding the old-style lock on the counter
+            return self._allocate_locked(dn, attrs, count)
+
+    def _allocate_increment(self, dn, attrs, count):
+        "Reserves IDs with modify-increment and a post-read control."
+        ctrl = PostReadControl(criticality=True, attrList=attrs)
+        msgid = self.ldap_wics.modify_ext(
+            dn, [(ldap.MOD_INCREMENT, attr, str(count)) for attr in attrs],
+            serverctrls=[ctrl])
+        (_, _, _, ctrls) = self.ldap_wics.result3(
+            msgid, resp_ctrl_classes={ctrl.controlType: PostReadControl})
+
+        for c in ctrls:
+            if c.controlType == PostReadControl.controlType:
+                return [int(c.entry[attr][0]) - count for attr in attrs]
+
+        raise ldap.PROTOCOL_ERROR('No post-read control returned for ' + dn)
+
+    def _allocate_cas(self, dn, attrs, count):
+        "Reserves IDs with a delete-old-value/add-new-value modify."
+        for x in range(CAS_TRIES):
+            entry = self.ldap_wics.search_s(dn, ldap.SCOPE_BASE,
+                                            attrlist=attrs)[0][1]
+            current = [int(entry[attr][0]) for attr in attrs]
+
+            ml = []
+            for (attr, value) in zip(attrs, current):
+                ml.append((ldap.MOD_DELETE, attr, str(value)))
+                ml.append((ldap.MOD_ADD, attr, str(value + count)))
+            try:
+                self.ldap_wics.modify_s(dn, ml)
+                return current
+            except ldap.NO_SUCH_ATTRIBUTE:
+                # Somebody else allocated between our read and our write
+                verbose('Lost allocation race on %s, retrying' % dn)
 
-        current_term = get_term()
+        raise ldap.TIMEOUT('Could not allocate IDs from ' + dn)
 
-        attrs_user = {
-            # 'uid': uid,
+    def _allocate_locked(self, dn, attrs, count):
+        "Reserves IDs while holding the modrdn lock on the counter."
+        (rdn, parent) = dn.split(',', 1)
+        lockrdn = rdn.split('=')[0] + '=inuse'
+        lockdn = lockrdn + ',' + parent
+
+        self.lock(dn, lockrdn)
+        try:
+            entry = self.ldap_wics.search_s(lockdn, ldap.SCOPE_BASE,
+                                            attrlist=attrs)[0][1]
+            current = [int(entry[attr][0]) for attr in attrs]
+            self.ldap_wics.modify_s(
+                lockdn, [(ldap.MOD_REPLACE, attr, str(value + count))
+                         for (attr, value) in zip(attrs, current)])
+        finally:
+            self.unlock(lockdn, rdn)
+
+        return current
+
+    def release_ids(self, dn, attrs, firsts, count=1):
+        '''
+        Hands reserved IDs back to the counter 'dn', but only if nobody has
+        allocated past them in the meantime; otherwise they are left as a gap.
+
+        dn: the distinguished name of the counter
+        attrs: the counter attributes passed to allocate_ids
+        firsts: the first reserved values returned by allocate_ids
+        count: how many values were reserved
+        '''
+        ml = []
+        for (attr, value) in zip(attrs, firsts):
+            ml.append((ldap.MOD_DELETE, attr, str(value + count)))
+            ml.append((ldap.MOD_ADD, attr, str(value)))
+        try:
+            self.ldap_wics.modify_s(dn, ml)
+        except (ldap.NO_SUCH_ATTRIBUTE, ldap.NO_SUCH_OBJECT):
+            debug('IDs %s were not returned to %s; later allocations have '
+                  'already moved past them.' % (firsts, dn))
+
+    def pipeline(self, max_inflight=None):
+        '''
+        Returns an ldap_pipeline over our connection, for sending many writes
+        without waiting on each one. Unless 'max_inflight' is given, all our
+        pipelines share one throttle, so what it learns about how much load
+        the server can take carries over from one batch to the next. Each
+        pipeline still keeps its own requests in flight, so one pipeline
+        can be used while another still has requests outstanding.
+
+        max_inflight: (optional) how many requests may be outstanding at once
+        '''
+        if max_inflight is not None:
+            return ldap_pipeline(self.ldap_wics, max_inflight)
+
+        pipe = ldap_pipeline(self.ldap_wics, throttle=self._throttle)
+        self._throttle = pipe.throttle
+        return pipe
+
+    def _user_attrs(self, uid, username, uid_number, gid_number,
+                    program=None):
+        "Builds the attributes for a new user entry."
+        attrs = {
+            'uid': uid,
             'cn': username,
             'objectClass': ['account', 'member', 'posixAccount',
                             'shadowAccount', 'top'],
             'homeDirectory': '/home/' + uid,
             'loginShell': '/bin/bash',
-            'uidNumber': str(next_uid),
-            'gidNumber': str(next_gid),
-            'term': current_term,
-            # 'program': program,  TODO: add query to uwldap for autocompletion
-            # 'cn': name,
+            'uidNumber': str(uid_number),
+            'gidNumber': str(gid_number),
+            'term': get_term(),
         }
+        if program:
+            attrs['program'] = program
+        return attrs
 
-        attrs_grp = {
-            'cn': uid,
+    def _group_attrs(self, gid, gid_number, desc=None):
+        "Builds the attributes for a new group entry."
+        attrs = {
+            'cn': gid,
             'objectClass': ['group', 'posixGroup', 'top'],
-            'gidNumber': str(next_gid),
+            'gidNumber': str(gid_number),
         }
+        if desc is not None:
+            attrs['description'] = desc
+        return attrs
 
-        try:
-            self.ldap_wics.modify_s(
-                'uid=inuse,ou=People,' + BASE,
-                [(ldap.MOD_REPLACE, 'uidNumber', str(next_uid + 1)),
-                 (ldap.MOD_REPLACE, 'gidNumber', str(next_gid + 1))])
+    def add_user(self, uid, username, program=None):
+        '''
+        Adds a user to the LDAP database.
+
+        uid: the unique user id for our new user
+        username: the user's full name
+        program: (optional) the user's program of study, e.g. as found by
+            uw_lookup
+        Returns True if the user was added.
+        '''
+        next_uid = next_gid = self.allocate_user_ids([uid])[uid]
+
+        attrs_user = self._user_attrs(uid, username, next_uid, next_gid,
+                                      program)
+        attrs_grp = self._group_attrs(uid, next_gid)
 
+        added = []
+        try:
             debug('Adding user...')
             verbose('dn: uid=%s,ou=People,%s' % (uid, BASE))
             ml = modlist.addModlist(attrs_user)
             verbose('modlist: ' + str(ml))
 
             self.ldap_wics.add_s('uid=%s,ou=People,%s' % (uid, BASE), ml)
+            added.append('uid=%s,ou=People,%s' % (uid, BASE))
 
             debug("Adding user's group...")
             verbose('dn: cn=%s,ou=Group,%s' % (uid, BASE))
@@ -145,19 +491,111 @@ class wics_ldap(object):
             verbose('modlist: ' + str(ml))
 
             self.ldap_wics.add_s('cn=%s,ou=Group,%s' % (uid, BASE), ml)
+            return True
 
         except:
             print_exc(sys.exc_info())
             error('Failed to add user!')
 
-            # Reset UID/GID before unlocking
-            self.ldap_wics.modify_s(
-                'uid=inuse,ou=People,' + BASE,
-                [(ldap.MOD_REPLACE, 'uidNumber', str(next_uid)),
-                 (ldap.MOD_REPLACE, 'gidNumber', str(next_gid))])
+            # Don't leave half a user behind, then try to return the IDs
+            for dn in added:
+                self.ldap_wics.delete_s(dn)
+            self.release_ids('uid=nextuid,ou=People,' + BASE,
+                             ['uidNumber', 'gidNumber'],
+                             [next_uid, next_gid])
+            return False
 
-        finally:
-            self.unlock('uid=inuse,ou=People,' + BASE, 'uid=nextuid')
+    def delete_user(self, uid):
+        '''
+        Deletes a user and their personal group from the LDAP database. Their
+        UID/GID numbers are not reused.
+
+        uid: the user to delete
+        '''
+        debug('Deleting user %s...' % uid)
+        self.ldap_wics.delete_s('uid=%s,ou=People,%s' % (uid, BASE))
+        self.ldap_wics.delete_s('cn=%s,ou=Group,%s' % (uid, BASE))
+
+    def allocate_user_ids(self, uids):
+        '''
+        Reserves a contiguous block of UID/GID numbers, one for each of the
+        users 'uids', with a single allocation.
+
+        Returns a dict mapping each user id to its UID/GID number.
+        '''
+        (next_uid, next_gid) = self.allocate_ids(
+            'uid=nextuid,ou=People,' + BASE, ['uidNumber', 'gidNumber'],
+            count=len(uids))
+
+        if next_uid != next_gid:
+            raise ldap.OBJECT_CLASS_VIOLATION(
+                "UID and GID on nextuid are out of sync. Run weo "
+                "--repair-counters, or tell the sysadmin!")
+
+        debug('Reserved UIDs %d-%d.' % (next_uid, next_uid + len(uids) - 1))
+        return dict((uid, next_uid + i) for (i, uid) in enumerate(uids))
+
+    def add_users(self, users, ids=None, exists_ok=(), programs=None):
+        '''
+        Adds many users to the LDAP database at once. A contiguous block of
+        UIDs/GIDs is reserved for the whole batch with a single allocation,
+        and the user and group adds are sent through a pipeline.
+
+        users: a list of (uid, username) tuples, already validated
+        ids: (optional) a dict of UID/GID numbers already reserved for the
+            users, as returned by allocate_user_ids
+        exists_ok: (optional) user ids whose entries may already exist, e.g.
+            when finishing an interrupted batch; for these, finding an entry
+            already there is not an error
+        programs: (optional) a dict mapping user ids to their programs
+        Returns a list of (uid, error) tuples, where error is None if the user
+        was added successfully.
+        '''
+        programs = programs or {}
+        if not users:
+            return []
+
+        allocated = ids is None
+        if allocated:
+            ids = self.allocate_user_ids([uid for (uid, _) in users])
+
+        debug('Adding %d users...' % len(users))
+        pipe = self.pipeline()
+        for (uid, username) in users:
+            pipe.add('uid=%s,ou=People,%s' % (uid, BASE), modlist.addModlist(
+                self._user_attrs(uid, username, ids[uid], ids[uid],
+                                 programs.get(uid))),
+                tag=(uid, 'uid=%s,ou=People,%s' % (uid, BASE)))
+            pipe.add('cn=%s,ou=Group,%s' % (uid, BASE), modlist.addModlist(
+                self._group_attrs(uid, ids[uid])),
+                tag=(uid, 'cn=%s,ou=Group,%s' % (uid, BASE)))
+
+        # Each user contributed a user and a group result, in that order
+        ops = pipe.results()
+        results = []
+        for (user_op, group_op) in zip(ops[::2], ops[1::2]):
+            uid = user_op[0][0]
+            errs = [e for (_, e) in (user_op, group_op) if e is not None and
+                    not (uid in exists_ok and
+                         isinstance(e, ldap.ALREADY_EXISTS))]
+            err = errs[0] if errs else None
+            if err is not None:
+                error('Failed to add user %s: %s' % (uid, err))
+                # Don't leave half a user behind
+                for ((_, dn), op_err) in (user_op, group_op):
+                    if op_err is None:
+                        pipe.delete(dn)
+            results.append((uid, err))
+        pipe.results()
+
+        if allocated and all(err is not None for (_, err) in results):
+            # Nothing was added, so try to hand the block back
+            first = min(ids.values())
+            self.release_ids('uid=nextuid,ou=People,' + BASE,
+                             ['uidNumber', 'gidNumber'], [first, first],
+                             count=len(users))
+
+        return results
 
     def add_group(self, gid, desc):
         '''
@@ -165,45 +603,29 @@ class wics_ldap(object):
 
         gid: the unique group id for our new group
         desc: a longer, descriptive name for the group
+        Returns True if the group was added.
         '''
-        self.lock('cn=nextgid,ou=Group,' + BASE, 'cn=inuse')
-        nextgid = self.ldap_wics.search_s(
-            'cn=inuse,ou=Group,' + BASE,
-            ldap.SCOPE_BASE)
+        (next_gid,) = self.allocate_ids('cn=nextgid,ou=Group,' + BASE,
+                                        ['gidNumber'])
 
-        nextgid = nextgid[0][1]
-        next_gid = int(nextgid['gidNumber'][0])
-
-        attrs = {
-            'cn': gid,
-            'objectClass': ['group', 'posixGroup', 'top'],
-            'gidNumber': str(next_gid),
-            'description': desc,
-        }
+        attrs = self._group_attrs(gid, next_gid, desc)
 
         try:
-            self.ldap_wics.modify_s(
-                'cn=inuse,ou=Group,' + BASE,
-                [(ldap.MOD_REPLACE, 'gidNumber', str(next_gid + 1))])
-
             debug('Adding group...')
             verbose('dn: cn=%s,ou=Group,%s' % (gid, BASE))
             ml = modlist.addModlist(attrs)
             verbose('modlist: ' + str(ml))
 
             self.ldap_wics.add_s('cn=%s,ou=Group,%s' % (gid, BASE), ml)
+            return True
 
         except:
             print_exc(sys.exc_info())
             error('Failed to add group!')
 
-            # Reset GID before unlocking
-            self.ldap_wics.modify_s(
-                'cn=inuse,ou=Group,' + BASE,
-                [(ldap.MOD_REPLACE, 'gidNumber', str(next_gid))])
-
-        finally:
-            self.unlock('cn=inuse,ou=Group,' + BASE, 'cn=nextgid')
+            self.release_ids('cn=nextgid,ou=Group,' + BASE, ['gidNumber'],
+                             [next_gid])
+            return False
 
     def add_user_to_group(self, gid, uid):
         '''
@@ -243,33 +665,300 @@ class wics_ldap(object):
             print_exc(sys.exc_info())
             error('Failed to remove user from group!')
 
-    def renew_user(self, uid, num_terms=None):
-        "Renews the user 'uid' for the current term, or a number of terms."
+    def membership_modlists(self, current, uids):
+        '''
+        Works out how to turn the uniqueMember values 'current' into exactly
+        the users 'uids', as a list of modlists of at most MEMBER_CHUNK values
+        each.
+
+        Returns a tuple (modlists, added, removed), where added and removed
+        are lists of member DNs.
+        '''
+        have = dict((normalize_dn(dn), dn) for dn in current)
+        want = dict((normalize_dn(dn), dn) for dn in
+                    ('uid=%s,ou=People,%s' % (uid, BASE) for uid in uids))
+
+        removed = sorted(have[dn] for dn in set(have) - set(want))
+        added = sorted(want[dn] for dn in set(want) - set(have))
+
+        changes = ([(ldap.MOD_DELETE, dn) for dn in removed] +
+                   [(ldap.MOD_ADD, dn) for dn in added])
+        modlists = []
+        for i in range(0, len(changes), MEMBER_CHUNK):
+            ml = []
+            for op in (ldap.MOD_DELETE, ldap.MOD_ADD):
+                values = [dn for (o, dn) in changes[i:i + MEMBER_CHUNK]
+                          if o == op]
+                if values:
+                    ml.append((op, 'uniqueMember', values))
+            modlists.append(ml)
+
+        return (modlists, added, removed)
+
+    def sync_group(self, gid, uids):
+        '''
+        Makes the members of the group 'gid' exactly the users 'uids'. The
+        group's current members are read once, and only the differences are
+        written, in as few modifies as possible.
+
+        gid: the group to sync
+        uids: the user ids that should be members
+        Returns a tuple (added, removed) of lists of member DNs.
+        '''
+        dn = 'cn=%s,ou=Group,%s' % (gid, BASE)
+        entry = self.ldap_wics.search_s(dn, ldap.SCOPE_BASE,
+                                        attrlist=['uniqueMember'])[0][1]
+
+        (modlists, added, removed) = self.membership_modlists(
+            entry.get('uniqueMember', []), uids)
+
+        debug('Syncing group %s: adding %d members, removing %d...' %
+              (gid, len(added), len(removed)))
+        for ml in modlists:
+            verbose('modlist: ' + str(ml))
+            self.ldap_wics.modify_s(dn, ml)
+
+        return (added, removed)
+
+    def _renewal_terms(self, num_terms):
+        '''
+        Works out which terms a renewal for 'num_terms' terms covers, or
+        returns None if 'num_terms' is nonsense.
+        '''
         if num_terms is None:
             num_terms = 1
         if num_terms > 3:
             debug('Warning: I can only renew a member for up to 3 terms at a '
                   'time! I will renew for the maximum possible number.')
-            term = 3
+            num_terms = 3
         if num_terms < 1:
             error("Your number of terms doesn't make any sense! You said: %s" %
                   num_terms)
+            return None
+
+        return get_terms(num_terms)
+
+    def renew_user(self, uid, num_terms=None):
+        "Renews the user 'uid' for the current term, or a number of terms."
+        terms = self._renewal_terms(num_terms)
+        if terms is None:
             return
 
-        terms = []
-        for num in range(num_terms):
-            terms.append(get_term(datetime.date.today() +
-                         relativedelta(months=(num * 4))))
+        dn = 'uid=%s,ou=People,%s' % (uid, BASE)
+        try:
+            debug('Renewing user for terms ' + ', '.join(terms))
+            verbose('dn: ' + dn)
+            ml = [(ldap.MOD_ADD, 'term', terms)]
+            verbose('modlist: ' + str(ml))
 
-        for term in terms:
             try:
-                debug('Renewing user for term ' + term)
-                verbose('dn: uid=%s,ou=People,%s' % (uid, BASE))
-                ml = [(ldap.MOD_ADD, 'term', term)]
-                verbose('modlist: ' + str(ml))
+                self.ldap_wics.modify_s(dn, ml)
+            except ldap.TYPE_OR_VALUE_EXISTS:
+                # Already paid up for some of them; add only the rest
+                entry = self.ldap_wics.search_s(dn, ldap.SCOPE_BASE,
+                                                attrlist=['term'])[0][1]
+                held = set(entry.get('term', []))
+                missing = [term for term in terms if term not in held]
+                if missing:
+                    self.ldap_wics.modify_s(
+                        dn, [(ldap.MOD_ADD, 'term', missing)])
+        except:
+            print_exc(sys.exc_info())
+            error('Failed to renew user for terms ' + ', '.join(terms) + '!')
 
+    def renew_users(self, uids, num_terms=None):
+        '''
+        Renews many users at once. Every user's existing terms are fetched up
+        front, users who already hold every term are skipped, and the rest
+        are renewed with one pipelined modify each.
+
+        uids: the user ids to renew
+        num_terms: (optional) the number of terms to renew for, up to three
+        Returns a tuple (renewed, current, failed) of lists of user ids, where
+        failed holds (uid, error) tuples.
+        '''
+        terms = self._renewal_terms(num_terms)
+        if terms is None:
+            return ([], [], [(uid, 'bad number of terms') for uid in uids])
+
+        # From the primary, so a replica that's behind doesn't have us add
+        # terms again that members already hold
+        debug('Fetching current terms for %d users...' % len(uids))
+        held = self.get_user_terms(uids, primary=True)
+
+        current = []
+        failed = []
+        pipe = self.pipeline()
+        for uid in uids:
+            if uid not in held:
+                failed.append((uid, 'no such user'))
+                continue
+
+            missing = [term for term in terms if term not in held[uid]]
+            if not missing:
+                current.append(uid)
+                continue
+
+            pipe.modify('uid=%s,ou=People,%s' % (uid, BASE),
+                        [(ldap.MOD_ADD, 'term', missing)], tag=uid)
+
+        renewed = []
+        raced = []
+        for (uid, err) in pipe.results():
+            if err is None:
+                renewed.append(uid)
+            elif isinstance(err, ldap.TYPE_OR_VALUE_EXISTS):
+                raced.append(uid)
+            else:
+                failed.append((uid, err))
+
+        # Someone else renewed these since we looked; add only what's still
+        # missing, as renew_user does
+        held = self.get_user_terms(raced, primary=True)
+        for uid in raced:
+            if uid not in held:
+                failed.append((uid, 'no such user'))
+                continue
+            missing = [term for term in terms if term not in held[uid]]
+            if not missing:
+                current.append(uid)
+                continue
+            try:
                 self.ldap_wics.modify_s('uid=%s,ou=People,%s' % (uid, BASE),
-                                        ml)
-            except:
-                print_exc(sys.exc_info())
-                error('Failed to renew user for term ' + term + '!')
+                                        [(ldap.MOD_ADD, 'term', missing)])
+                renewed.append(uid)
+            except ldap.LDAPError as e:
+                failed.append((uid, e))
+
+        return (renewed, current, failed)
+
+    def search_by(self, base, attr, values, attrlist=None, conn=None,
+                  scope=ldap.SCOPE_ONELEVEL, primary=False):
+        '''
+        Searches 'base' for entries whose 'attr' is any of 'values', using a
+        few large OR filters rather than one search per value. The search
+        goes to a replica unless 'primary' is set.
+
+        conn: (optional) the connection to search, for our own use; callers
+            outside this class pass 'primary' instead, so that traces
+            record something that can be replayed
+        scope: (optional) the search scope; defaults to one level
+        Returns a list of (dn, entry) tuples.
+        '''
+        conn = conn or (self.ldap_wics if primary else self.ldap_read)
+        values = list(values)
+        found = []
+        for i in range(0, len(values), FILTER_CHUNK):
+            filterstr = '(|%s)' % ''.join(
+                '(%s=%s)' % (attr, ldap.filter.escape_filter_chars(value))
+                for value in values[i:i + FILTER_CHUNK])
+            found.extend(conn.search_s(base, scope, filterstr, attrlist))
+        return found
+
+    def uw_lookup(self, uids):
+        '''
+        Looks up the users 'uids' in the UW directory, a few hundred per
+        search. See wics_cache.uw_lookup for a cached version.
+
+        Returns a dict mapping each user id that was found to a dict of its
+        'cn' and 'program', either of which may be None.
+        '''
+        debug('Looking up %d users in the UW directory...' % len(uids))
+        found = {}
+        for (dn, entry) in self.search_by(
+                UW_BASE, 'uid', uids, ['uid', 'cn', UW_PROGRAM_ATTR],
+                conn=self.ldap_uw, scope=ldap.SCOPE_SUBTREE):
+            if 'uid' not in entry:
+                continue
+            found[entry['uid'][0].lower()] = {
+                'cn': entry.get('cn', [None])[0],
+                'program': entry.get(UW_PROGRAM_ATTR, [None])[0],
+            }
+        return found
+
+    def find_existing(self, uids=(), gids=(), primary=False):
+        '''
+        Finds which of the user ids 'uids' and group names 'gids' are already
+        taken, with a few chunked OR-filter searches rather than discovering
+        each clash when its add fails.
+
+        primary: (optional) whether to search the primary, not a replica
+        Returns a tuple (users, groups) of the sets of names that exist.
+        '''
+        def names(found):
+            return set(ldap.dn.str2dn(dn)[0][0][1].lower()
+                       for (dn, _) in found)
+
+        users = names(self.search_by('ou=People,' + BASE, 'uid', uids,
+                                     ['1.1'], primary=primary))
+        groups = names(self.search_by('ou=Group,' + BASE, 'cn', gids,
+                                      ['1.1'], primary=primary))
+        return (users, groups)
+
+    def get_user_terms(self, uids, primary=False):
+        '''
+        Looks up the terms held by each of the users 'uids'.
+
+        primary: (optional) whether to search the primary, not a replica
+        Returns a dict mapping each user id that exists to a set of terms.
+        '''
+        held = {}
+        for (_, entry) in self.search_by('ou=People,' + BASE, 'uid', uids,
+                                         ['uid', 'term'],
+                                         primary=primary):
+            held[entry['uid'][0]] = set(entry.get('term', []))
+        return held
+
+    def search_paged(self, base, filterstr='(objectClass=*)', attrlist=None,
+                     scope=ldap.SCOPE_ONELEVEL, primary=False):
+        '''
+        Searches 'base' using the Simple Paged Results control, yielding
+        (dn, entry) tuples as each page arrives, so that large result sets
+        never need to be held in memory or hit the server's size limit.
+        The search goes to a replica unless 'primary' is set.
+        '''
+        conn = self.ldap_wics if primary else self.ldap_read
+        ctrl = SimplePagedResultsControl(True, size=PAGE_SIZE, cookie='')
+        while True:
+            msgid = conn.search_ext(base, scope, filterstr, attrlist,
+                                    serverctrls=[ctrl])
+            (_, data, _, ctrls) = conn.result3(
+                msgid, resp_ctrl_classes={
+                    ctrl.controlType: SimplePagedResultsControl})
+
+            for (dn, entry) in data:
+                if dn is not None:  # skip search references
+                    yield (dn, entry)
+
+            cookies = [c.cookie for c in ctrls
+                       if c.controlType == ctrl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            ctrl.cookie = cookies[0]
+
+    def list_members(self, term=None, attrlist=None):
+        '''
+        Yields the (dn, entry) of every member, or only of those who have paid
+        for the term 'term'.
+        '''
+        filterstr = '(objectClass=member)'
+        if term is not None:
+            filterstr = '(&%s(term=%s))' % (
+                filterstr, ldap.filter.escape_filter_chars(term))
+
+        return self.search_paged('ou=People,' + BASE, filterstr, attrlist)
+
+    def list_expired(self, since, attrlist=None, primary=False):
+        '''
+        Yields the (dn, entry) of every member who holds none of the terms
+        from 'since' onwards, i.e. who hasn't renewed since before 'since'.
+        The search goes to a replica unless 'primary' is set.
+        '''
+        # Renewals can run up to three terms ahead of the current one
+        terms = term_range(since, get_terms(3)[-1])
+        filterstr = '(&(objectClass=member)(!(|%s)))' % ''.join(
+            '(term=%s)' % ldap.filter.escape_filter_chars(term)
+            for term in terms)
+
+        return self.search_paged('ou=People,' + BASE, filterstr, attrlist,
+                                 primary=primary)
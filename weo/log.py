@@ -23,6 +23,9 @@ VERBOSE = False
 DEBUG = True
 DAS_ERROR = False
 
+# When set to a list, error messages are also collected here
+CAPTURE = None
+
 
 # Configurable logging
 
@@ -44,6 +47,9 @@ def error(statement):
     global DAS_ERROR
     DAS_ERROR = True
 
+    if CAPTURE is not None:
+        CAPTURE.append(statement)
+
     # Error messages are always printed
     sys.stderr.write(statement + '\n')
 
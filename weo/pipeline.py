@@ -0,0 +1,128 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import collections
+import ldap
+import time
+
+from weo import config
+from weo.log import verbose
+from weo.stats import record, unwrap
+from weo.throttle import aimd_throttle
+
+# Default ceiling on the number of LDAP requests to keep in flight
+MAX_INFLIGHT = 32
+
+# Most LDAP writes to start per second, or 0 for no limit
+MAX_RATE = config.get_float('ldap', 'max_rate')
+
+
+class ldap_pipeline(object):
+    '''
+    Issues LDAP writes using python-ldap's asynchronous, message ID based
+    calls, keeping several of them outstanding at once rather than waiting a
+    full round trip for each. How many is decided by a throttle, which
+    raises the number while the server keeps up and backs off when it
+    doesn't.
+    '''
+
+    def __init__(self, conn, max_inflight=None, throttle=None):
+        '''
+        conn: an open, bound LDAPObject
+        max_inflight: (optional) the most requests that may be outstanding at
+            once; defaults to MAX_INFLIGHT
+        throttle: (optional) an aimd_throttle to share with other pipelines
+            to the same server, so they share what it learns; by default
+            each pipeline has its own
+        '''
+        # Each operation is timed from when it's sent until its result
+        # arrives, rather than as the separate calls that send and reap it
+        (self.conn, prefix) = unwrap(conn)
+        self._prefix = prefix or 'ldap'
+        self.throttle = throttle or aimd_throttle(
+            max_inflight or MAX_INFLIGHT, rate=MAX_RATE, name='ldap')
+
+        # Outstanding message IDs, oldest first, mapped to their result slot,
+        # the time they were sent and the name to record them under
+        self._inflight = collections.OrderedDict()
+        self._results = []
+
+    def add(self, dn, ml, tag=None):
+        '''
+        Queues an add of the entry 'dn' with the add modlist 'ml'. 'tag' is
+        returned alongside the result, and defaults to the DN.
+        '''
+        verbose('pipeline add: ' + dn)
+        return self._submit('add', (dn, ml), tag or dn)
+
+    def modify(self, dn, ml, tag=None):
+        "Queues a modify of the entry 'dn' with the modlist 'ml'."
+        verbose('pipeline modify: ' + dn)
+        return self._submit('modify', (dn, ml), tag or dn)
+
+    def delete(self, dn, tag=None):
+        "Queues a delete of the entry 'dn'."
+        verbose('pipeline delete: ' + dn)
+        return self._submit('delete', (dn,), tag or dn)
+
+    def _submit(self, op, args, tag):
+        # Each pipeline keeps its own window of the size the throttle has
+        # learned: waiting on the throttle's slots could mean waiting on
+        # another pipeline on this same thread, which would never reap them
+        while self._inflight and len(self._inflight) >= self.throttle.window():
+            self._reap()
+
+        name = '%s.%s' % (self._prefix, op)
+        started = self.throttle.acquire(wait=False)
+        try:
+            msgid = getattr(self.conn, op + '_ext')(*args)
+        except ldap.LDAPError as e:
+            self.throttle.release(started, e)
+            record(name, time.time() - started, True)
+            raise
+        self._inflight[msgid] = (len(self._results), started, name)
+        self._results.append((tag, None))
+        return msgid
+
+    def _reap(self):
+        "Waits for the oldest outstanding request to complete."
+        (msgid, (slot, started, name)) = self._inflight.popitem(last=False)
+        try:
+            self.conn.result3(msgid)
+        except ldap.LDAPError as e:
+            self._results[slot] = (self._results[slot][0], e)
+            self.throttle.release(started, e)
+            record(name, time.time() - started, True)
+        else:
+            self.throttle.release(started)
+            record(name, time.time() - started)
+
+    def results(self):
+        '''
+        Waits for every outstanding request to complete.
+
+        Returns a list of (tag, error) tuples in the order the operations were
+        queued, where error is None if the operation succeeded, or else the
+        LDAPError it raised.
+        '''
+        while self._inflight:
+            self._reap()
+
+        results = self._results
+        self._results = []
+        return results
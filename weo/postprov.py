@@ -0,0 +1,174 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import os
+import Queue
+import shutil
+import subprocess
+import threading
+
+from weo import config
+from weo.log import debug, error, verbose
+
+# Post-provisioning is what happens on the host once a user is in LDAP and
+# Kerberos: their home directory is created from SKEL_DIR and handed over to
+# them, then each of HOOKS is called and each of HOOK_SCRIPTS is run. Users
+# are worked through on a pool of WORKERS threads, since most of the time
+# goes on filesystem and NFS round trips.
+#
+# It only runs where it's turned on, with 'enabled' in the [postprov]
+# section of the config, or with --post-provision.
+
+ENABLED = config.get_boolean('postprov', 'enabled')
+SKEL_DIR = config.get('postprov', 'skel')
+HOME_MODE = int(config.get('postprov', 'home_mode'), 8)
+WORKERS = int(config.get('postprov', 'workers'))
+
+# Executables run for each new user, with the user id as their argument and
+# WEO_UID, WEO_UIDNUMBER, WEO_GIDNUMBER and WEO_HOME in their environment
+HOOK_SCRIPTS = config.get_list('postprov', 'hooks')
+
+# Python callables run for each new user, as fn(uid, user), where user is a
+# dict of the user's uidNumber, gidNumber and homeDirectory. Site modules
+# named by 'plugins' in the config are imported before the first run, and
+# add to these with register.
+HOOKS = []
+PLUGINS = config.get_list('postprov', 'plugins')
+
+
+def register(fn):
+    "Adds 'fn' to the hooks run for each new user. Usable as a decorator."
+    HOOKS.append(fn)
+    return fn
+
+
+def _load_plugins():
+    while PLUGINS:
+        name = PLUGINS.pop(0)
+        verbose('Loading post-provisioning plugin %s' % name)
+        __import__(name)
+
+
+def _chown_tree(path, uid_number, gid_number):
+    os.lchown(path, uid_number, gid_number)
+    for (root, dirs, files) in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid_number, gid_number)
+
+
+def make_home(user):
+    '''
+    Creates a user's home directory, fills it from SKEL_DIR, and gives it to
+    them. A home directory that already exists is left as it is.
+
+    user: a dict of the user's uidNumber, gidNumber and homeDirectory
+    '''
+    home = user['homeDirectory']
+    if os.path.exists(home):
+        verbose('%s already exists, leaving it alone' % home)
+        return
+
+    debug('Creating %s...' % home)
+    if SKEL_DIR and os.path.isdir(SKEL_DIR):
+        shutil.copytree(SKEL_DIR, home, symlinks=True)
+    else:
+        os.makedirs(home)
+    os.chmod(home, HOME_MODE)
+    _chown_tree(home, user['uidNumber'], user['gidNumber'])
+
+
+def run_hooks(uid, user):
+    '''
+    Runs the Python hooks and then the hook scripts for the new user 'uid'.
+    Raises an exception if any of them fail.
+    '''
+    for fn in HOOKS:
+        verbose('%s: hook %s' % (uid, fn.__name__))
+        fn(uid, user)
+
+    env = dict(os.environ, WEO_UID=uid,
+               WEO_UIDNUMBER=str(user['uidNumber']),
+               WEO_GIDNUMBER=str(user['gidNumber']),
+               WEO_HOME=user['homeDirectory'])
+    for script in HOOK_SCRIPTS:
+        verbose('%s: running %s' % (uid, script))
+        status = subprocess.call([script, uid], env=env)
+        if status != 0:
+            raise OSError('%s exited with status %d' % (script, status))
+
+
+def post_provision(l, uids, workers=None):
+    '''
+    Sets up newly provisioned users on this host: their home directories,
+    then any hooks. The users' entries are read from the primary, in a few
+    chunked searches, so that they are there even if the replicas haven't
+    caught up yet.
+
+    l: an open wics_ldap
+    uids: the user ids that were just added
+    workers: (optional) how many users to work on at once; defaults to
+        WORKERS
+    Returns a dict mapping each uid to None on success, or else the
+    exception that was raised.
+    '''
+    from weo.ldap import BASE
+
+    _load_plugins()
+    users = {}
+    for (_, entry) in l.search_by(
+            'ou=People,' + BASE, 'uid', uids,
+            ['uid', 'uidNumber', 'gidNumber', 'homeDirectory'],
+            primary=True):
+        users[entry['uid'][0]] = {
+            'uidNumber': int(entry['uidNumber'][0]),
+            'gidNumber': int(entry['gidNumber'][0]),
+            'homeDirectory': entry['homeDirectory'][0],
+        }
+
+    errors = dict((uid, KeyError('no such user %s' % uid))
+                  for uid in uids if uid not in users)
+    work = Queue.Queue()
+    for uid in uids:
+        if uid in users:
+            work.put(uid)
+
+    def worker():
+        while True:
+            try:
+                uid = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                make_home(users[uid])
+                run_hooks(uid, users[uid])
+                errors[uid] = None
+            except Exception as e:
+                errors[uid] = e
+
+    debug('Setting up %d users on this host...' % work.qsize())
+    threads = [threading.Thread(target=worker)
+               for x in range(min(workers or WORKERS, work.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for (uid, err) in sorted(errors.items()):
+        if err is not None:
+            error('Failed to set up %s on this host: %s' % (uid, err))
+    return errors
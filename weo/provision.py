@@ -0,0 +1,181 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import sys
+import threading
+
+from weo.journal import wics_journal
+from weo.krb5 import is_duplicate
+from weo.log import debug, error, print_exc
+
+# Provisioning runs the LDAP and Kerberos halves of adding a user side by
+# side, since both spend nearly all their time waiting on the network, then
+# undoes whichever half succeeded if the other one failed.
+
+
+def _in_thread(fn, *args):
+    '''
+    Starts running fn(*args) in a new thread. Returns the thread and a dict
+    that will hold the 'result' or the 'exc_info' once it has finished.
+    '''
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = fn(*args)
+        except Exception:
+            outcome['exc_info'] = sys.exc_info()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return (thread, outcome)
+
+
+def _rollback(l, k, uid, ldap_ok, krb_ok):
+    "Undoes the half of adding 'uid' that succeeded, if only one did."
+    try:
+        if ldap_ok and not krb_ok:
+            debug('Rolling back LDAP entries for %s...' % uid)
+            l.delete_user(uid)
+        elif krb_ok and not ldap_ok:
+            debug('Rolling back Kerberos principal for %s...' % uid)
+            k.del_princ(uid)
+    except Exception:
+        print_exc(sys.exc_info())
+        error('Failed to roll back %s; it needs cleaning up by hand!' % uid)
+
+
+def provision_user(l, k, uid, username, password, program=None):
+    '''
+    Adds a user to LDAP and Kerberos concurrently. If either fails, the other
+    is rolled back.
+
+    l: an open wics_ldap
+    k: an open wics_krb5
+    uid: the unique user id for our new user
+    username: the user's full name
+    password: the user's password
+    program: (optional) the user's program of study
+    Returns True if the user was added to both.
+    '''
+    (ldap_thread, ldap_outcome) = _in_thread(l.add_user, uid, username,
+                                             program)
+    (krb_thread, krb_outcome) = _in_thread(k.add_princ, uid, password)
+    ldap_thread.join()
+    krb_thread.join()
+
+    for outcome in (ldap_outcome, krb_outcome):
+        if 'exc_info' in outcome:
+            print_exc(outcome['exc_info'])
+
+    ldap_ok = bool(ldap_outcome.get('result'))
+    krb_ok = 'exc_info' not in krb_outcome
+    _rollback(l, k, uid, ldap_ok, krb_ok)
+
+    return ldap_ok and krb_ok
+
+
+def provision_users(l, k, users, journal=None, programs=None):
+    '''
+    Adds many users to LDAP and Kerberos. The LDAP batch and the Kerberos
+    principals are worked through side by side, so Kerberos work for one
+    user overlaps LDAP work for the next; any user who makes it into only
+    one of the two is rolled back.
+
+    With a journal, every step is recorded before and after it is taken, so
+    the same batch can be rerun after a crash: the reserved block of IDs is
+    reused, finished steps are skipped, and steps that may have half
+    happened are finished off rather than reported as clashes.
+
+    l: an open wics_ldap
+    k: an open wics_krb5 or wics_krb5_pool
+    users: a list of (uid, username, password) tuples, already validated
+    journal: (optional) a wics_journal to record progress in
+    programs: (optional) a dict mapping user ids to their programs of study
+    Returns a list of (uid, error) tuples, where error is None if the user
+    was added successfully.
+    '''
+    if journal is None:
+        journal = wics_journal()
+
+    ldap_todo = [(uid, username) for (uid, username, _) in users
+                 if not journal.is_done(uid, 'add_user')]
+    krb_todo = [(uid, password) for (uid, _, password) in users
+                if not journal.is_done(uid, 'add_princ')]
+    ldap_retry = set(uid for (uid, _) in ldap_todo
+                     if journal.is_pending(uid, 'add_user'))
+    krb_retry = set(uid for (uid, _) in krb_todo
+                    if journal.is_pending(uid, 'add_princ'))
+
+    # Reserve IDs for the whole batch once, and reuse them on a rerun so a
+    # crash doesn't leak the block
+    ids = journal.data('*', 'allocate').get('ids')
+    if not journal.is_done('*', 'allocate') and ldap_todo:
+        journal.intend('*', 'allocate', count=len(users))
+        journal.sync()
+        ids = l.allocate_user_ids([uid for (uid, _, _) in users])
+        journal.complete('*', 'allocate', ids=ids)
+    elif ldap_todo and any(uid not in ids for (uid, _) in ldap_todo):
+        raise ValueError('The journal %s is for a different batch of users.'
+                         % journal.path)
+    for (uid, _) in ldap_todo:
+        journal.intend(uid, 'add_user', id=ids[uid])
+    for (uid, _) in krb_todo:
+        journal.intend(uid, 'add_princ')
+    journal.sync()
+
+    (ldap_thread, ldap_outcome) = _in_thread(
+        l.add_users, ldap_todo, ids, ldap_retry, programs)
+    (krb_thread, krb_outcome) = _in_thread(k.add_princs, krb_todo)
+    ldap_thread.join()
+    krb_thread.join()
+
+    if 'exc_info' in ldap_outcome:
+        print_exc(ldap_outcome['exc_info'])
+        ldap_errors = dict((uid, ldap_outcome['exc_info'][1])
+                           for (uid, _) in ldap_todo)
+    else:
+        ldap_errors = dict(ldap_outcome['result'])
+    if 'exc_info' in krb_outcome:
+        print_exc(krb_outcome['exc_info'])
+        krb_errors = dict((uid, krb_outcome['exc_info'][1])
+                          for (uid, _) in krb_todo)
+    else:
+        krb_errors = krb_outcome['result']
+    for uid in krb_retry:
+        # The principal made it in before we were interrupted
+        if is_duplicate(krb_errors.get(uid)):
+            krb_errors[uid] = None
+
+    results = []
+    for (uid, _, _) in users:
+        ldap_err = ldap_errors.get(uid)
+        krb_err = krb_errors.get(uid)
+        err = ldap_err or krb_err
+        if err is not None:
+            _rollback(l, k, uid, ldap_err is None, krb_err is None)
+        for (step, step_err) in (('add_user', ldap_err),
+                                 ('add_princ', krb_err)):
+            if err is None:
+                journal.complete(uid, step)
+            else:
+                # Rolled back or never happened, so a rerun starts afresh
+                journal.fail(uid, step, error=str(step_err))
+        results.append((uid, err))
+    journal.sync()
+    return results
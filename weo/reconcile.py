@@ -0,0 +1,213 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import json
+import ldap
+import ldap.dn
+import ldap.modlist as modlist
+
+from weo.ldap import BASE
+from weo.log import debug, error, verbose
+from weo.utils import check_term, check_username, get_term, to_utf8
+
+# A desired-state file lists users and groups:
+#
+#   users:
+#     - uid: amy
+#       cn: Amy Smith
+#       terms: [f2026, w2027]
+#   groups:
+#     - cn: sysadmins
+#       description: Systems Committee
+#       members: [amy]
+#
+# Only the attributes given are managed: a user without 'terms' keeps
+# whatever terms they have. Users and groups that aren't listed are left
+# alone.
+
+
+def load_state(path):
+    '''
+    Reads and validates a desired-state file, which may be JSON or, if
+    PyYAML is installed, YAML.
+
+    Returns a dict with 'users' and 'groups' lists.
+    '''
+    with open(path) as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError('Reading YAML state files needs PyYAML; '
+                                 'install it or use JSON instead')
+            state = yaml.safe_load(f)
+        else:
+            state = json.load(f)
+
+    # Values are compared with, and written as, LDAP's UTF-8 str
+    state = to_utf8(state or {})
+    state = {'users': state.get('users') or [],
+             'groups': state.get('groups') or []}
+    for user in state['users']:
+        check_username(user['uid'])
+        for term in user.get('terms', []):
+            check_term(term)
+    for group in state['groups']:
+        check_username(group['cn'], maxlen=10)
+        for uid in group.get('members', []):
+            check_username(uid)
+
+    return state
+
+
+def plan(l, state):
+    '''
+    Compares the desired state with the directory, read in one paged sweep of
+    each of ou=People and ou=Group, and works out the smallest set of writes
+    that will make them match.
+
+    l: an open wics_ldap
+    state: a desired state, as returned by load_state
+    Returns a list of actions, each one of
+        ('add_user', uid, cn, terms),
+        ('add_group', cn, description, members),
+        ('modify', dn, modlist)
+    where terms, description and members may be None if not managed.
+    '''
+    want_users = dict((u['uid'], u) for u in state['users'])
+    want_groups = dict((g['cn'], g) for g in state['groups'])
+
+    actions = []
+    have_users = set()
+    for (dn, entry) in l.search_paged('ou=People,' + BASE,
+                                      '(objectClass=member)',
+                                      ['uid', 'cn', 'term'], primary=True):
+        uid = entry['uid'][0] if 'uid' in entry else \
+            ldap.dn.str2dn(dn)[0][0][1]
+        if uid not in want_users:
+            continue
+        have_users.add(uid)
+
+        want = want_users[uid]
+        (old, new) = ({}, {})
+        if 'cn' in want:
+            old['cn'] = entry.get('cn', [])
+            new['cn'] = [want['cn']]
+        if 'terms' in want:
+            old['term'] = entry.get('term', [])
+            new['term'] = sorted(want['terms'])
+        ml = modlist.modifyModlist(old, new)
+        if ml:
+            actions.append(('modify', dn, ml))
+
+    have_groups = set()
+    for (dn, entry) in l.search_paged('ou=Group,' + BASE, '(objectClass=*)',
+                                      ['cn', 'description', 'uniqueMember'],
+                                      primary=True):
+        cn = ldap.dn.str2dn(dn)[0][0][1]
+        if cn not in want_groups:
+            continue
+        have_groups.add(cn)
+
+        want = want_groups[cn]
+        ml = []
+        if 'description' in want:
+            ml = modlist.modifyModlist(
+                {'description': entry.get('description', [])},
+                {'description': [want['description']]})
+        if ml:
+            actions.append(('modify', dn, ml))
+        if 'members' in want:
+            (modlists, _, _) = l.membership_modlists(
+                entry.get('uniqueMember', []), want['members'])
+            actions.extend(('modify', dn, ml) for ml in modlists)
+
+    for uid in sorted(set(want_users) - have_users):
+        want = want_users[uid]
+        actions.append(('add_user', uid, want.get('cn', uid),
+                        want.get('terms')))
+    for cn in sorted(set(want_groups) - have_groups):
+        want = want_groups[cn]
+        actions.append(('add_group', cn, want.get('description', cn),
+                        want.get('members')))
+
+    return actions
+
+
+def describe(action):
+    "Returns a line describing 'action' for a dry-run plan"
+    if action[0] == 'add_user':
+        return 'add user %s (%s), terms %s' % (
+            action[1], action[2], ', '.join(action[3] or [get_term()]))
+    if action[0] == 'add_group':
+        return 'add group %s (%s), members %s' % (
+            action[1], action[2], ', '.join(action[3] or []) or 'none')
+
+    changes = []
+    for (op, attr, values) in action[2]:
+        verb = {ldap.MOD_ADD: 'add', ldap.MOD_DELETE: 'delete',
+                ldap.MOD_REPLACE: 'replace'}[op]
+        if values is None:
+            changes.append('%s %s' % (verb, attr))
+        else:
+            changes.append('%s %s %s' % (verb, attr, ', '.join(values)))
+    return 'modify %s: %s' % (action[1], '; '.join(changes))
+
+
+def _report(pipe):
+    "Waits for the pipelined modifies in 'pipe', reporting any that failed."
+    for (dn, err) in pipe.results():
+        if err is not None:
+            error('Failed to modify %s: %s' % (dn, err))
+
+
+def apply(l, actions):
+    '''
+    Carries out the actions from plan. Modifies are pipelined; new users are
+    added as one batch.
+
+    l: an open wics_ldap
+    actions: a list of actions, as returned by plan
+    '''
+    pipe = l.pipeline()
+    for action in actions:
+        if action[0] == 'modify':
+            verbose(describe(action))
+            pipe.modify(action[1], action[2])
+    _report(pipe)
+
+    new_users = [a for a in actions if a[0] == 'add_user']
+    if new_users:
+        debug('Adding %d users...' % len(new_users))
+        results = dict(l.add_users([(uid, cn) for (_, uid, cn, _)
+                                    in new_users]))
+        for (_, uid, _, terms) in new_users:
+            if results[uid] is not None:
+                error('Failed to add user %s: %s' % (uid, results[uid]))
+            elif terms is not None and sorted(terms) != [get_term()]:
+                pipe.modify('uid=%s,ou=People,%s' % (uid, BASE),
+                            [(ldap.MOD_REPLACE, 'term', sorted(terms))])
+
+    for (_, cn, desc, members) in [a for a in actions if a[0] == 'add_group']:
+        debug('Adding group %s...' % cn)
+        if l.add_group(cn, desc) and members:
+            (modlists, _, _) = l.membership_modlists([], members)
+            for ml in modlists:
+                pipe.modify('cn=%s,ou=Group,%s' % (cn, BASE), ml)
+
+    _report(pipe)
@@ -0,0 +1,323 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import mmap
+import os
+import struct
+import time
+
+from weo.utils import rdn_value
+
+# A snapshot is a read-only copy of the passwd and group data in the WiCS
+# LDAP DB, laid out so that it can be mmapped and searched in place: shell
+# hosts can look users up without a network round trip, and without
+# parsing anything up front.
+#
+# All integers are little-endian and unsigned. The file is:
+#
+#   header      MAGIC, VERSION, the time it was written, the number of
+#               users and groups, then the offsets of the four sections and
+#               four indexes below
+#   strings     UTF-8 strings, referred to by (offset, length) pairs
+#   users       USER records: uidNumber, gidNumber, and string refs for
+#               uid, cn, homeDirectory and loginShell
+#   groups      GROUP records: gidNumber, a string ref for cn, and the
+#               position and count of the group's members
+#   members     string refs for the user ids of every group's members
+#   indexes     by uid, uidNumber, group cn and gidNumber; each is a slot
+#               count (a power of two) and that many slots, each holding
+#               a record number plus one, or zero if empty. Keys are hashed
+#               with 32-bit FNV-1a, and collisions probe linearly.
+#
+# Numeric keys are hashed as their four byte encoding.
+
+MAGIC = 'WEOSNAP\0'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIQII4I4I')
+REF = struct.Struct('<II')
+USER = struct.Struct('<II8I')
+GROUP = struct.Struct('<IIIII')
+SLOT = struct.Struct('<I')
+NUMBER = struct.Struct('<I')
+
+FNV_OFFSET = 0x811c9dc5
+FNV_PRIME = 0x01000193
+
+
+def fnv1a(data):
+    "Returns the 32-bit FNV-1a hash of the byte string 'data'."
+    h = FNV_OFFSET
+    for c in data:
+        h = ((h ^ ord(c)) * FNV_PRIME) & 0xffffffff
+    return h
+
+
+def _build_index(keys):
+    '''
+    Builds an open-addressing hash table over the byte strings 'keys', which
+    are numbered by their position.
+
+    Returns the packed index.
+    '''
+    slots = 8
+    while slots < 2 * len(keys):
+        slots *= 2
+
+    table = [0] * slots
+    for (num, key) in enumerate(keys):
+        i = fnv1a(key) & (slots - 1)
+        while table[i]:
+            i = (i + 1) & (slots - 1)
+        table[i] = num + 1
+
+    return SLOT.pack(slots) + struct.pack('<%dI' % slots, *table)
+
+
+class _strings(object):
+    "Collects the string table, storing each distinct string once."
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.refs = {}
+
+    def ref(self, value):
+        value = value or ''
+        if value not in self.refs:
+            self.refs[value] = (self.size, len(value))
+            self.chunks.append(value)
+            self.size += len(value)
+        return self.refs[value]
+
+
+def write_snapshot(l, path):
+    '''
+    Writes a snapshot of the users and groups in LDAP to 'path', in one
+    paged pass over each of ou=People and ou=Group. The snapshot is written
+    to a temporary file beside 'path' and renamed over it once complete, so
+    readers only ever see a whole snapshot.
+
+    l: an open wics_ldap
+    path: where to write the snapshot
+    Returns a tuple (users, groups) of how many of each were written.
+    '''
+    from weo.cache import COUNTERS
+    from weo.ldap import BASE
+
+    strings = _strings()
+
+    users = []
+    for (dn, entry) in l.search_paged(
+            'ou=People,' + BASE, '(objectClass=posixAccount)',
+            ['uid', 'cn', 'uidNumber', 'gidNumber', 'homeDirectory',
+             'loginShell']):
+        uid = entry['uid'][0] if 'uid' in entry else rdn_value(dn)
+        if uid in COUNTERS or 'uidNumber' not in entry:
+            continue
+        users.append((uid, int(entry['uidNumber'][0]),
+                      int(entry.get('gidNumber', [0])[0]),
+                      entry.get('cn', [''])[0],
+                      entry.get('homeDirectory', [''])[0],
+                      entry.get('loginShell', [''])[0]))
+    users.sort(key=lambda user: user[1])
+
+    groups = []
+    for (dn, entry) in l.search_paged(
+            'ou=Group,' + BASE, '(objectClass=posixGroup)',
+            ['cn', 'gidNumber', 'uniqueMember']):
+        cn = entry['cn'][0] if 'cn' in entry else rdn_value(dn)
+        if cn in COUNTERS or 'gidNumber' not in entry:
+            continue
+        groups.append((cn, int(entry['gidNumber'][0]),
+                       sorted(set(rdn_value(member) for member in
+                                  entry.get('uniqueMember', [])))))
+    groups.sort(key=lambda group: group[1])
+
+    user_records = []
+    for (uid, uid_number, gid_number, cn, home, shell) in users:
+        refs = (strings.ref(uid) + strings.ref(cn) + strings.ref(home) +
+                strings.ref(shell))
+        user_records.append(USER.pack(uid_number, gid_number, *refs))
+
+    group_records = []
+    member_refs = []
+    for (cn, gid_number, members) in groups:
+        group_records.append(GROUP.pack(
+            gid_number, *(strings.ref(cn) + (len(member_refs),
+                                             len(members)))))
+        member_refs.extend(REF.pack(*strings.ref(member))
+                           for member in members)
+
+    indexes = [
+        _build_index([user[0] for user in users]),
+        _build_index([NUMBER.pack(user[1]) for user in users]),
+        _build_index([group[0] for group in groups]),
+        _build_index([NUMBER.pack(group[1]) for group in groups]),
+    ]
+
+    sections = [''.join(strings.chunks), ''.join(user_records),
+                ''.join(group_records), ''.join(member_refs)] + indexes
+    offsets = []
+    offset = HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+
+    header = HEADER.pack(MAGIC, VERSION, int(time.time()), len(users),
+                         len(groups), *offsets)
+
+    tmp = '%s.tmp.%d' % (path, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            for section in sections:
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+    return (len(users), len(groups))
+
+
+class wics_snapshot(object):
+    '''
+    Reads a snapshot written by write_snapshot. The file is mmapped, and
+    lookups hash straight into its indexes, so opening one is cheap and each
+    lookup touches only the few pages it needs.
+
+    A reader keeps the snapshot it opened even if a newer one is renamed
+    over it; open the path again to pick up the new one.
+    '''
+
+    def __init__(self, path):
+        '''
+        path: the snapshot file
+        Raises ValueError if the file isn't a snapshot this reader
+        understands.
+        '''
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < HEADER.size:
+            raise ValueError('%s is not a weo snapshot' % path)
+        fields = HEADER.unpack_from(self.map, 0)
+        (magic, version, self.written, self.num_users,
+         self.num_groups) = fields[:5]
+        if magic != MAGIC:
+            raise ValueError('%s is not a weo snapshot' % path)
+        if version != VERSION:
+            raise ValueError('%s is a version %d snapshot; expected %d' %
+                             (path, version, VERSION))
+
+        (self._strings, self._users, self._groups, self._members,
+         self._by_uid, self._by_uidnumber, self._by_cn,
+         self._by_gidnumber) = fields[5:]
+
+    def close(self):
+        self.map.close()
+
+    def _str(self, offset, length):
+        start = self._strings + offset
+        return self.map[start:start + length]
+
+    def _lookup(self, index, key, matches):
+        "Finds the record number whose key is 'key', or None."
+        (slots,) = SLOT.unpack_from(self.map, index)
+        i = fnv1a(key) & (slots - 1)
+        while True:
+            (num,) = SLOT.unpack_from(self.map, index + SLOT.size * (i + 1))
+            if num == 0:
+                return None
+            if matches(num - 1):
+                return num - 1
+            i = (i + 1) & (slots - 1)
+
+    def user(self, num):
+        '''
+        Returns the user with record number 'num' as a dict of uid, cn,
+        uidNumber, gidNumber, homeDirectory and loginShell.
+        '''
+        fields = USER.unpack_from(self.map, self._users + USER.size * num)
+        refs = fields[2:]
+        return {
+            'uid': self._str(*refs[0:2]),
+            'cn': self._str(*refs[2:4]),
+            'uidNumber': fields[0],
+            'gidNumber': fields[1],
+            'homeDirectory': self._str(*refs[4:6]),
+            'loginShell': self._str(*refs[6:8]),
+        }
+
+    def group(self, num):
+        '''
+        Returns the group with record number 'num' as a dict of cn,
+        gidNumber and members (as user ids).
+        '''
+        (gid_number, offset, length, first, count) = GROUP.unpack_from(
+            self.map, self._groups + GROUP.size * num)
+        members = [self._str(*REF.unpack_from(
+            self.map, self._members + REF.size * i))
+            for i in range(first, first + count)]
+        return {'cn': self._str(offset, length), 'gidNumber': gid_number,
+                'members': members}
+
+    def _user_field(self, num, field):
+        return USER.unpack_from(self.map, self._users + USER.size * num)[field]
+
+    def _group_field(self, num, field):
+        return GROUP.unpack_from(self.map,
+                                 self._groups + GROUP.size * num)[field]
+
+    def get_user(self, uid):
+        "Looks up a user by user id, returning it as user does, or None."
+        num = self._lookup(self._by_uid, uid, lambda n: self._str(
+            self._user_field(n, 2), self._user_field(n, 3)) == uid)
+        return self.user(num) if num is not None else None
+
+    def get_user_by_uidnumber(self, uid_number):
+        "Looks up a user by UID number, returning it as user does, or None."
+        num = self._lookup(self._by_uidnumber, NUMBER.pack(uid_number),
+                           lambda n: self._user_field(n, 0) == uid_number)
+        return self.user(num) if num is not None else None
+
+    def get_group(self, cn):
+        "Looks up a group by name, returning it as group does, or None."
+        num = self._lookup(self._by_cn, cn, lambda n: self._str(
+            self._group_field(n, 1), self._group_field(n, 2)) == cn)
+        return self.group(num) if num is not None else None
+
+    def get_group_by_gidnumber(self, gid_number):
+        "Looks up a group by GID number, returning it as group does, or None."
+        num = self._lookup(self._by_gidnumber, NUMBER.pack(gid_number),
+                           lambda n: self._group_field(n, 0) == gid_number)
+        return self.group(num) if num is not None else None
+
+    def users(self):
+        "Iterates over every user, in order of UID number."
+        for num in xrange(self.num_users):
+            yield self.user(num)
+
+    def groups(self):
+        "Iterates over every group, in order of GID number."
+        for num in xrange(self.num_groups):
+            yield self.group(num)
@@ -0,0 +1,177 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import json
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class op_stats(object):
+    'Call count, error count and latency histogram for one kind of operation'
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+
+    def add(self, duration, failed):
+        self.count += 1
+        self.errors += int(failed)
+        self.total += duration
+        self.max = max(self.max, duration)
+        for (i, bound) in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def quantile(self, q):
+        "Estimates the q'th quantile as the bound of the bucket it falls in"
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= q * self.count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) \
+                    else self.max
+        return 0.0
+
+
+# All stats recorded by this process, by operation name
+STATS = {}
+_lock = threading.Lock()
+
+
+def record(name, duration, failed=False):
+    '''
+    Records one operation.
+
+    name: the operation, e.g. 'ldap.modify_s'
+    duration: how long it took, in seconds
+    failed: (optional) whether it raised an error
+    '''
+    with _lock:
+        STATS.setdefault(name, op_stats()).add(duration, failed)
+
+
+class instrumented(object):
+    '''
+    Wraps an object, such as an LDAP or kadmin connection, so that every
+    method call on it is timed and recorded under "<prefix>.<method>".
+    '''
+
+    def __init__(self, obj, prefix):
+        self._obj = obj
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        op = '%s.%s' % (self._prefix, name)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            failed = True
+            try:
+                result = attr(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                record(op, time.time() - start, failed)
+
+        return timed
+
+
+def unwrap(obj):
+    '''
+    Returns a tuple (obj, prefix) of the object an instrumented wraps and the
+    prefix its calls are recorded under, or (obj, None) if it isn't one.
+    For callers that time whole operations themselves.
+    '''
+    if isinstance(obj, instrumented):
+        return (obj._obj, obj._prefix)
+    return (obj, None)
+
+
+@contextlib.contextmanager
+def timed(op):
+    "Times the block it wraps, recording it as the operation 'op'."
+    start = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        record(op, time.time() - start, failed)
+
+
+def report(fmt='text'):
+    '''
+    Renders everything recorded so far.
+
+    fmt: 'text' for a human-readable summary, 'json', or 'prometheus' for
+        the Prometheus text exposition format
+    '''
+    with _lock:
+        names = sorted(STATS)
+        stats = [(name, STATS[name]) for name in names]
+
+    if fmt == 'json':
+        return json.dumps(dict(
+            (name, {'count': s.count, 'errors': s.errors, 'total': s.total,
+                    'max': s.max, 'buckets': dict(zip(
+                        [str(b) for b in BUCKETS] + ['+Inf'], s.buckets))})
+            for (name, s) in stats), sort_keys=True, indent=2)
+
+    if fmt == 'prometheus':
+        lines = ['# HELP weo_op_duration_seconds Time spent in LDAP and '
+                 'Kerberos operations.',
+                 '# TYPE weo_op_duration_seconds histogram']
+        for (name, s) in stats:
+            seen = 0
+            for (bound, n) in zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                  s.buckets):
+                seen += n
+                lines.append('weo_op_duration_seconds_bucket'
+                             '{op="%s",le="%s"} %d' % (name, bound, seen))
+            lines.append('weo_op_duration_seconds_sum{op="%s"} %f' %
+                         (name, s.total))
+            lines.append('weo_op_duration_seconds_count{op="%s"} %d' %
+                         (name, s.count))
+        lines += ['# HELP weo_op_errors_total LDAP and Kerberos operations '
+                  'that failed.',
+                  '# TYPE weo_op_errors_total counter']
+        for (name, s) in stats:
+            lines.append('weo_op_errors_total{op="%s"} %d' %
+                         (name, s.errors))
+        return '\n'.join(lines) + '\n'
+
+    lines = ['%-32s %7s %6s %9s %9s %9s %9s' %
+             ('operation', 'count', 'errors', 'mean ms', 'p50 ms', 'p99 ms',
+              'max ms')]
+    for (name, s) in stats:
+        lines.append('%-32s %7d %6d %9.1f %9.1f %9.1f %9.1f' % (
+            name, s.count, s.errors, 1000 * s.total / s.count,
+            1000 * s.quantile(0.5), 1000 * s.quantile(0.99), 1000 * s.max))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,147 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import ldap
+
+from weo.cache import COUNTERS
+from weo.ldap import BASE, normalize_dn
+from weo.log import debug, error, verbose
+from weo.utils import get_term, term_range
+
+# A sweep finds members who haven't renewed since before some term, and
+# either disables them, which can be undone, or deletes them outright.
+#
+# Disabling sets their login shell to DISABLED_SHELL and expires their
+# Kerberos principal, but leaves their entries and group memberships alone
+# so that they can be re-enabled by hand if they renew late. Deleting removes
+# their People entry, their personal group, every uniqueMember reference to
+# them, and their principal.
+
+DISABLED_SHELL = '/sbin/nologin'
+
+
+def plan(l, before, delete=False):
+    '''
+    Works out what a sweep of the members who haven't renewed since before
+    the term 'before' would do. Lapsed members are found in one paged
+    search, and their personal groups and memberships in a few chunked
+    ones. Everything is read from the primary, so that a member who has
+    just renewed isn't swept because a replica hasn't heard yet.
+
+    l: an open wics_ldap
+    before: the earliest term a member must hold to be kept, e.g. 'w2026'
+    delete: (optional) delete lapsed members rather than disabling them
+    Returns a list of actions, each one of
+        ('modify', dn, modlist),
+        ('delete', dn),
+        ('lock_princ', uid),
+        ('del_princ', uid)
+    in the order they should be carried out.
+    '''
+    if not term_range(before, get_term()):
+        raise ValueError('%s has not started yet; sweeping before it would '
+                         'catch members who are paid up' % before)
+
+    lapsed = {}
+    for (dn, entry) in l.list_expired(before, ['uid', 'loginShell'],
+                                      primary=True):
+        if 'uid' in entry and entry['uid'][0] not in COUNTERS:
+            shell = entry.get('loginShell', [None])[0]
+            lapsed[entry['uid'][0]] = (dn, shell)
+    uids = sorted(lapsed)
+    debug('Found %d members who have not renewed since before %s.' %
+          (len(uids), before))
+
+    if not delete:
+        actions = [('modify', lapsed[uid][0],
+                    [(ldap.MOD_REPLACE, 'loginShell', DISABLED_SHELL)])
+                   for uid in uids if lapsed[uid][1] != DISABLED_SHELL]
+        return actions + [('lock_princ', uid) for uid in uids]
+
+    # Other groups stop referring to them before the entries go away
+    actions = []
+    dns = [lapsed[uid][0] for uid in uids]
+    gone = set(normalize_dn(dn) for dn in dns)
+    for (dn, entry) in l.search_by('ou=Group,' + BASE, 'uniqueMember', dns,
+                                   ['uniqueMember'], primary=True):
+        members = [member for member in entry.get('uniqueMember', [])
+                   if normalize_dn(member) in gone]
+        if members:
+            actions.append(('modify', dn,
+                            [(ldap.MOD_DELETE, 'uniqueMember', members)]))
+
+    (_, groups) = l.find_existing((), uids, primary=True)
+    actions.extend(('delete', 'cn=%s,ou=Group,%s' % (uid, BASE))
+                   for uid in uids if uid in groups)
+    actions.extend(('delete', dn) for dn in dns)
+    return actions + [('del_princ', uid) for uid in uids]
+
+
+def describe(action):
+    "Returns a line describing 'action' for a dry-run report"
+    if action[0] == 'lock_princ':
+        return 'lock principal %s' % action[1]
+    if action[0] == 'del_princ':
+        return 'delete principal %s' % action[1]
+    if action[0] == 'delete':
+        return 'delete %s' % action[1]
+
+    (op, attr, values) = action[2][0]
+    if op == ldap.MOD_REPLACE:
+        return 'modify %s: set %s to %s' % (action[1], attr, values)
+    return 'modify %s: remove %s %s' % (action[1], attr, ', '.join(values))
+
+
+def apply(l, k, actions):
+    '''
+    Carries out the actions from plan. LDAP changes are pipelined, and
+    principals are locked or deleted across a kadmin pool once the LDAP
+    side is done.
+
+    l: an open wics_ldap
+    k: an open wics_krb5 or wics_krb5_pool
+    actions: a list of actions, as returned by plan
+    '''
+    pipe = l.pipeline()
+    for action in actions:
+        if action[0] == 'modify':
+            verbose(describe(action))
+            pipe.modify(action[1], action[2])
+    # Deletes have to wait for the memberships they depend on to be removed
+    for (dn, err) in pipe.results():
+        if err is not None:
+            error('Failed to modify %s: %s' % (dn, err))
+
+    for action in actions:
+        if action[0] == 'delete':
+            verbose(describe(action))
+            pipe.delete(action[1])
+    for (dn, err) in pipe.results():
+        if err is not None and not isinstance(err, ldap.NO_SUCH_OBJECT):
+            error('Failed to delete %s: %s' % (dn, err))
+
+    for (kind, method, doing, verb) in (
+            ('lock_princ', 'lock_princs', 'Locking', 'lock'),
+            ('del_princ', 'del_princs', 'Deleting', 'delete')):
+        uids = [action[1] for action in actions if action[0] == kind]
+        if not uids:
+            continue
+        debug('%s %d Kerberos principals...' % (doing, len(uids)))
+        for (uid, err) in sorted(getattr(k, method)(uids).items()):
+            if err is not None:
+                error('Failed to %s principal %s: %s' % (verb, uid, err))
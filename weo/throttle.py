@@ -0,0 +1,148 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import threading
+import time
+
+from weo.log import verbose
+
+# How many requests a throttle starts out allowing in flight, and the fewest
+# it will ever back off to
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+
+# A request slower than this multiple of the fastest recent ones, plus some
+# slack in seconds for jitter on a fast network, means the server is
+# queueing, so we back off
+LATENCY_TOLERANCE = 2.0
+LATENCY_SLACK = 0.05
+
+# What the limit is multiplied by when backing off
+BACKOFF = 0.5
+
+# Exception class names that mean the server is overloaded, rather than that
+# the request itself was bad: python-ldap's BUSY, UNAVAILABLE, TIMEOUT and
+# SERVER_DOWN
+OVERLOAD_ERRORS = frozenset(['BUSY', 'UNAVAILABLE', 'TIMEOUT', 'SERVER_DOWN'])
+
+
+def is_overload(e):
+    "Whether the exception 'e' means the server is under too much load."
+    return type(e).__name__ in OVERLOAD_ERRORS
+
+
+class aimd_throttle(object):
+    '''
+    Limits how many requests bulk operations have in flight against a server,
+    and optionally how many they start per second.
+
+    The limit is adjusted AIMD-style, like TCP's congestion window: while
+    requests complete quickly it grows by about one per round of requests,
+    and when they slow down or the server reports that it is busy it is cut
+    in half, at most once per round. This finds roughly the most concurrency
+    the server can take without queueing, and backs off quickly when it is
+    also busy with someone else.
+
+    Throttles are thread safe, so one can be shared by several workers.
+    '''
+
+    def __init__(self, maximum, rate=None, name='throttle'):
+        '''
+        maximum: the most requests ever allowed in flight at once
+        rate: (optional) the most requests to start per second
+        name: (optional) what to call the throttle in verbose messages
+        '''
+        self.maximum = maximum
+        self.rate = float(rate) if rate else None
+        self.name = name
+        self.limit = float(min(INITIAL_LIMIT, maximum))
+        self.inflight = 0
+
+        self._cond = threading.Condition()
+        self._baseline = None  # latency of the fastest recent requests
+        self._next_start = 0
+        self._completed = 0
+        self._cut_at = 0
+
+    def window(self):
+        "How many requests may be in flight at once, as currently learned."
+        return max(int(self.limit), MIN_LIMIT)
+
+    def has_room(self):
+        "Whether another request may be sent without waiting for one to end."
+        return self.inflight < self.window()
+
+    def acquire(self, wait=True):
+        '''
+        Takes a slot for a new request, waiting for one to free up if need be
+        and 'wait' is set, then waits until the rate limit allows it to start.
+
+        Returns the start time to pass to release.
+        '''
+        with self._cond:
+            while wait and not self.has_room():
+                self._cond.wait()
+            self.inflight += 1
+
+            now = time.time()
+            delay = self._next_start - now
+            if self.rate:
+                self._next_start = max(now, self._next_start) + 1 / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+        return time.time()
+
+    def release(self, started, error=None):
+        '''
+        Gives back the slot taken by acquire, and adjusts the limit according
+        to how the request went.
+
+        started: the time returned by acquire
+        error: (optional) the exception the request raised, if any
+        '''
+        latency = time.time() - started
+        with self._cond:
+            self.inflight -= 1
+            self._completed += 1
+
+            if self._baseline is None or latency < self._baseline:
+                self._baseline = latency
+            else:
+                # Drift up slowly, so one lucky request doesn't set the bar
+                # forever
+                self._baseline += (latency - self._baseline) * 0.01
+
+            if (is_overload(error) or
+                    latency > self._baseline * LATENCY_TOLERANCE +
+                    LATENCY_SLACK):
+                self._back_off(error or '%.3fs' % latency)
+            elif error is None and self.limit < self.maximum:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+            self._cond.notify_all()
+
+    def _back_off(self, reason):
+        # Requests sent before the last cut are still reporting in; don't
+        # punish the same congestion twice
+        if self._completed < self._cut_at:
+            return
+        self.limit = max(self.limit * BACKOFF, MIN_LIMIT)
+        self._cut_at = self._completed + self.inflight + 1
+        verbose('%s: backing off to %d in flight (%s)' %
+                (self.name, self.limit, reason))
@@ -0,0 +1,201 @@
+# Copyright (C) 2015 Elana Hashman
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+
+import gzip
+import itertools
+import json
+import threading
+import time
+import types
+
+# A trace records every call made on the wics_ldap and wics_krb5 objects of
+# a run, so the same load can be replayed later; see weo.bench.replay. It is
+# a gzipped file with one JSON object per line:
+#
+#   {"t": 0.52, "dur": 0.013, "obj": "ldap", "session": 0,
+#    "op": "renew_user", "args": ["amy", 2], "kwargs": {}, "err": null}
+#
+# where 't' is when the call started, in seconds since recording began,
+# 'session' numbers each connection opened, and 'err' is the name of the
+# exception the call raised, if any. Opening a connection is recorded as
+# an op of 'connect'. Writes sent through a pipeline are recorded as calls
+# on an obj of 'ldap.pipeline', with a session of their own.
+
+# The trace being written, while recording
+TRACE = None
+
+# What passwords are replaced with in a trace
+REDACTED = '<redacted>'
+
+
+def _redact_password(args, kwargs, pos):
+    if len(args) > pos and args[pos] is not None:
+        args[pos] = REDACTED
+    if kwargs.get('password') is not None:
+        kwargs['password'] = REDACTED
+
+
+def _redact_users(args, kwargs, pos):
+    users = args[0] if args else kwargs.get('users', [])
+    for user in users:
+        if len(user) > pos and user[pos] is not None:
+            user[pos] = REDACTED
+
+
+# Calls whose arguments include passwords, by op, with where to find them
+REDACT = {
+    'add_princ': lambda args, kwargs: _redact_password(args, kwargs, 1),
+    'add_princs': lambda args, kwargs: _redact_users(args, kwargs, 1),
+}
+
+
+def _plain(value):
+    "Converts tuples and sets to lists, so arguments can be redacted."
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for (k, v) in value.items())
+    return value
+
+
+class trace_writer(object):
+    "Writes a trace file, from any number of threads."
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wb')
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._sessions = itertools.count()
+
+    def new_session(self):
+        with self._lock:
+            return next(self._sessions)
+
+    def write(self, obj, session, op, args, kwargs, start, duration, err):
+        args = _plain(list(args))
+        kwargs = _plain(kwargs)
+        if op in REDACT:
+            REDACT[op](args, kwargs)
+
+        line = json.dumps({
+            't': round(start - self.start, 6), 'dur': round(duration, 6),
+            'obj': obj, 'session': session, 'op': op, 'args': args,
+            'kwargs': kwargs, 'err': err}, sort_keys=True, default=repr)
+        with self._lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+class traced(object):
+    '''
+    Wraps a wics_ldap or wics_krb5 so that every call of one of its public
+    methods is written to the trace. Calls the object makes on itself
+    aren't, so replaying a trace exercises the same code paths again.
+    '''
+
+    def __init__(self, obj, name, session):
+        self._obj = obj
+        self._name = name
+        self._session = session
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            start = time.time()
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                self._write(attr, args, kwargs, start, type(e).__name__)
+                raise
+
+            if isinstance(result, types.GeneratorType):
+                # Searches do their work as they are consumed
+                return self._consume(attr, args, kwargs, start, result)
+            self._write(attr, args, kwargs, start, None)
+            if attr == 'pipeline' and TRACE is not None:
+                # Its writes are the ones worth replaying
+                return traced(result, self._name + '.pipeline',
+                              TRACE.new_session())
+            return result
+
+        return call
+
+    def _write(self, attr, args, kwargs, start, err):
+        if TRACE is not None:
+            TRACE.write(self._name, self._session, attr, args, kwargs,
+                        start, time.time() - start, err)
+
+    def _consume(self, attr, args, kwargs, start, results):
+        try:
+            for result in results:
+                yield result
+        except Exception as e:
+            self._write(attr, args, kwargs, start, type(e).__name__)
+            raise
+        self._write(attr, args, kwargs, start, None)
+
+
+def start(path):
+    "Starts recording a trace to 'path'."
+    global TRACE
+    TRACE = trace_writer(path)
+
+
+def stop():
+    "Stops recording, if we were, and finishes the trace file."
+    global TRACE
+    if TRACE is not None:
+        TRACE.close()
+        TRACE = None
+
+
+def connect(name, factory, *args, **kwargs):
+    '''
+    Opens a connection by calling factory(*args, **kwargs), e.g. wics_ldap().
+    While recording, the time it took is written to the trace, and the
+    connection is wrapped so that its calls are too.
+
+    name: what to call the connection in the trace: 'ldap', 'krb5' or
+        'krb5_pool'
+    '''
+    if TRACE is None:
+        return factory(*args, **kwargs)
+
+    start = time.time()
+    obj = factory(*args, **kwargs)
+    session = TRACE.new_session()
+    TRACE.write(name, session, 'connect', (), {}, start, time.time() - start,
+                None)
+    return traced(obj, name, session)
+
+
+def read_trace(path):
+    "Yields each call recorded in the trace at 'path', as a dict."
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        f.close()
@@ -13,8 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import csv
 import datetime
 import getpass
+import json
+import sys
 
 
 # Utility functions
@@ -62,3 +65,101 @@ def get_term(date=None):
         return 's' + str(year)
     else:  # month <= 12
         return 'f' + str(year)
+
+
+SEASONS = 'wsf'
+
+
+def check_term(term):
+    '''
+    Validates a term name 'term' such as 'f2026', by ensuring it is one of
+    w, s or f followed by a four-digit year.
+    '''
+    if (len(term) == 5 and term[0] in SEASONS and term[1:].isdigit()):
+        return term
+    else:
+        raise ValueError(
+            'Terms must look like w2016, s2016 or f2016, received %s' % term)
+
+
+def term_range(first, last):
+    "Returns every term from 'first' up to and including 'last', in order"
+    (season, year) = (SEASONS.index(first[0]), int(first[1:]))
+    end = (int(last[1:]), SEASONS.index(last[0]))
+
+    terms = []
+    while (year, season) <= end:
+        terms.append(SEASONS[season] + str(year))
+        season += 1
+        if season == len(SEASONS):
+            (season, year) = (0, year + 1)
+    return terms
+
+
+def get_terms(num_terms, date=None):
+    "Returns the 'num_terms' consecutive terms starting with the current one"
+    from dateutil.relativedelta import relativedelta
+
+    if date is None:
+        date = datetime.date.today()
+
+    return [get_term(date + relativedelta(months=(num * 4)))
+            for num in range(num_terms)]
+
+
+def rdn_value(dn):
+    "Returns the value of the first RDN of 'dn', e.g. 'foo' for uid=foo,..."
+    return dn.split(',', 1)[0].split('=', 1)[1]
+
+
+def to_utf8(value):
+    '''
+    Encodes the unicode strings in 'value', which may be nested in lists and
+    dicts, as UTF-8 str. JSON and YAML give back unicode, but python-ldap
+    only takes str.
+    '''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_utf8(v) for v in value]
+    if isinstance(value, dict):
+        return dict((to_utf8(k), to_utf8(v)) for (k, v) in value.items())
+    return value
+
+
+def read_batch_file(path, fields):
+    '''
+    Reads the rows of a batch input file, returning a list of dicts keyed by
+    'fields'. Files ending in .json or .jsonl are read as one JSON object per
+    line; anything else is read as CSV, with columns in the order given by
+    'fields' and an optional header row. A path of '-' reads standard input.
+
+    path: the path of the batch file
+    fields: the column names, e.g. ['username', 'fullname']
+    '''
+    if path == '-':
+        f = sys.stdin
+    else:
+        f = open(path, 'rb')
+
+    rows = []
+    try:
+        if path.endswith('.json') or path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    obj = to_utf8(json.loads(line))
+                    rows.append(dict((k, obj.get(k)) for k in fields))
+        else:
+            for record in csv.reader(f):
+                if not record or record[0].startswith('#'):
+                    continue
+                if not rows and record[0].strip() == fields[0]:
+                    continue  # header row
+                record = [value.strip() for value in record]
+                record += [None] * (len(fields) - len(record))
+                rows.append(dict(zip(fields, record)))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    return rows